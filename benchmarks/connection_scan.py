@@ -0,0 +1,62 @@
+"""Benchmark full day connection scans from every station of a date.
+
+Run from the repository root once data was downloaded:
+    python benchmarks/connection_scan.py [--date YYYY-MM-DD]
+"""
+
+import argparse
+import datetime
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    "..", "tgvmax_mapper"))
+
+import numpy as np
+
+from connections import MIN_TRANSFER_MIN
+from dataset import Dataset
+from settings import SNAPSHOT_DIR, CSV_COORDS
+from store import SnapshotStore
+
+TRANSFERS_COUNTS = [0, 1, 2]
+
+
+def main(argv):
+    """Print scan times of every departure station for each transfers count."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--date", type=datetime.date.fromisoformat, \
+        default=datetime.date.today() + datetime.timedelta(days=1))
+    parser.add_argument("--store", default=SNAPSHOT_DIR)
+    parser.add_argument("--coords", default=CSV_COORDS)
+    args = parser.parse_args(argv)
+
+    dataset = Dataset.load_current(SnapshotStore(args.store), args.coords)
+    start = time.perf_counter()
+    connections = dataset.connection_scan()
+    print("sort_ms\t" + str(round((time.perf_counter() - start) * 1000)))
+    date = args.date.toordinal()
+    first, last = connections.day_bounds(date)
+    origins = np.unique(connections.origins[first:last])
+    if not len(origins):
+        print("ERROR : no journey on " + str(args.date))
+        return 1
+
+    print("transfers\tstations\treached\tmean_ms\tmax_ms")
+    for max_transfers in TRANSFERS_COUNTS:
+        times, reached = [], 0
+        for origin in origins:
+            start = time.perf_counter()
+            result = connections.scan(origin, date, \
+                min_transfer=MIN_TRANSFER_MIN, max_transfers=max_transfers)
+            times.append(time.perf_counter() - start)
+            reached += int((result.parents[-1] >= 0).sum())
+        print(str(max_transfers) + "\t" + str(len(origins)) + "\t" + \
+            str(reached // len(origins)) + "\t" + \
+            str(round(np.mean(times) * 1000, 2)) + "\t" + \
+            str(round(max(times) * 1000, 2)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,65 @@
+"""Benchmark reachable destinations from bitsets against full searches.
+
+Run from the repository root once data was downloaded:
+    python benchmarks/reachability.py [--date YYYY-MM-DD] [--stay DAYS]
+"""
+
+import argparse
+import datetime
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    "..", "tgvmax_mapper"))
+
+import numpy as np
+
+from dataset import Dataset
+from search import MapCreator, make_user_entries, DESTINATION
+from settings import SNAPSHOT_DIR, CSV_COORDS
+from store import SnapshotStore
+
+
+def timed(task, user_entries):
+    """Get the result and elapsed time of one search."""
+    start = time.perf_counter()
+    result = task(user_entries)
+    return result, time.perf_counter() - start
+
+def main(argv):
+    """Print mean times of reachable destinations from every station."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--date", type=datetime.date.fromisoformat, \
+        default=datetime.date.today() + datetime.timedelta(days=1))
+    parser.add_argument("--stay", type=int, default=2, \
+        help="days before return, 0 for one-way searches")
+    parser.add_argument("--store", default=SNAPSHOT_DIR)
+    parser.add_argument("--coords", default=CSV_COORDS)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    dataset = Dataset.load_current(SnapshotStore(args.store), args.coords)
+    print("load_ms\t" + str(round((time.perf_counter() - start) * 1000)))
+    map_creator = MapCreator(None, dataset)
+    return_date = args.date + datetime.timedelta(days=args.stay) \
+        if args.stay else None
+
+    bitsets_s, search_s, mismatches = [], [], 0
+    for origin in dataset.snapshot.cities:
+        user_entries = make_user_entries(origin, args.date, 6, 22, \
+            return_date, 6, 22)
+        reached, elapsed = timed(map_creator.reachable, user_entries)
+        bitsets_s.append(elapsed)
+        dataframe, elapsed = timed(map_creator.compute, user_entries)
+        search_s.append(elapsed)
+        mismatches += reached != sorted(set(dataframe[DESTINATION]))
+
+    print("stations\tbitsets_us\tsearch_us\tmismatches")
+    print(str(len(bitsets_s)) + "\t" + \
+        str(round(np.mean(bitsets_s) * 1e6)) + "\t" + \
+        str(round(np.mean(search_s) * 1e6)) + "\t" + str(mismatches))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
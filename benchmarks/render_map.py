@@ -0,0 +1,80 @@
+"""Benchmark map rendering time and HTML size against results count.
+
+Run from the repository root once data was downloaded:
+    python benchmarks/render_map.py [--from ORIGIN] [--date YYYY-MM-DD]
+"""
+
+import argparse
+import datetime
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    "..", "tgvmax_mapper"))
+
+import pandas as pd
+
+from dataset import Dataset
+from search import MapCreator, make_user_entries, DESTINATION, LAT, LON
+from settings import SNAPSHOT_DIR, CSV_COORDS
+from store import SnapshotStore
+
+DEFAULT_ORIGIN = "PARIS (intramuros)"
+RESULTS_COUNTS = [100, 1000, 10000, 50000]
+REPEATS = 3
+
+
+def round_trips(map_creator, origin, date):
+    """Get round trips with a two days stay, as a results sample."""
+    user_entries = make_user_entries(origin, date, 3, 24, \
+        date + datetime.timedelta(days=2), 3, 24)
+    return user_entries, map_creator.search(user_entries)
+
+def scaled(dataframe, count):
+    """Get a results frame of count rows, repeating the sample if needed.
+
+    Each copy of the sample gets its own destinations, slightly moved.
+    """
+    copies = []
+    for copy in range(-(-count // len(dataframe))):
+        copies.append(dataframe.assign(**{
+            DESTINATION : dataframe[DESTINATION] + " #" + str(copy),
+            LAT : dataframe[LAT] + copy * 0.01,
+            LON : dataframe[LON] + copy * 0.01
+        }))
+    return pd.concat(copies, ignore_index=True).head(count)
+
+def main(argv):
+    """Print render time and HTML size for each results count."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--from", dest="origin", default=DEFAULT_ORIGIN)
+    parser.add_argument("--date", type=datetime.date.fromisoformat, \
+        default=datetime.date.today() + datetime.timedelta(days=1))
+    parser.add_argument("--store", default=SNAPSHOT_DIR)
+    parser.add_argument("--coords", default=CSV_COORDS)
+    args = parser.parse_args(argv)
+
+    dataset = Dataset.load_current(SnapshotStore(args.store), args.coords)
+    map_creator = MapCreator(None, dataset)
+    user_entries, sample = round_trips(map_creator, args.origin, args.date)
+    if sample.empty:
+        print("ERROR : no round trip from " + args.origin + " on " + \
+            str(args.date))
+        return 1
+
+    print("rows\tdestinations\trender_ms\thtml_kB")
+    for count in RESULTS_COUNTS:
+        dataframe = scaled(sample, count)
+        best = None
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            html = map_creator.render_html(dataframe, user_entries)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(str(count) + "\t" + str(dataframe[DESTINATION].nunique()) + \
+            "\t" + str(round(best * 1000)) + "\t" + str(len(html) // 1024))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,67 @@
+"""Benchmark saved searches evaluation against the number of searches.
+
+Run from the repository root once data was downloaded:
+    python benchmarks/subscriptions.py [--counts 10 100 1000 5000]
+"""
+
+import argparse
+import datetime
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    "..", "tgvmax_mapper"))
+
+import numpy as np
+
+from dataset import Dataset
+from search import make_user_entries
+from settings import SNAPSHOT_DIR, CSV_COORDS
+from snapshot import COL_DATE
+from store import SnapshotStore
+from subscriptions import SubscriptionEngine
+
+
+def random_searches(dataset, count, rng):
+    """Get saved searches from random origins, dates and hours windows."""
+    dates = np.unique(dataset.snapshot.column(COL_DATE))
+    subscriptions = {}
+    for sub_id in range(count):
+        origin = dataset.snapshot.cities[rng.integers(len( \
+            dataset.snapshot.cities))]
+        date = datetime.date.fromordinal(int(dates[rng.integers( \
+            len(dates))]))
+        minh = int(rng.integers(3, 20))
+        return_date = None
+        if rng.random() < 0.5:
+            return_date = date + datetime.timedelta(days=int(rng.integers(1, \
+                3)))
+        subscriptions[str(sub_id)] = (str(sub_id), make_user_entries(origin, \
+            date, minh, minh + int(rng.integers(1, 6)), return_date, 6, 22))
+    return subscriptions
+
+def main(argv):
+    """Print evaluation time of saved searches for each count."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--counts", type=int, nargs="+", \
+        default=[10, 100, 1000, 5000])
+    parser.add_argument("--store", default=SNAPSHOT_DIR)
+    parser.add_argument("--coords", default=CSV_COORDS)
+    args = parser.parse_args(argv)
+
+    dataset = Dataset.load_current(SnapshotStore(args.store), args.coords)
+    engine = SubscriptionEngine(dataset)
+    rng = np.random.default_rng(0)
+    print("searches\tms\tus_per_search")
+    for count in args.counts:
+        subscriptions = random_searches(dataset, count, rng)
+        start = time.perf_counter()
+        engine.evaluate(subscriptions)
+        elapsed = time.perf_counter() - start
+        print(str(count) + "\t" + str(round(elapsed * 1000)) + "\t" + \
+            str(round(elapsed * 1e6 / count)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
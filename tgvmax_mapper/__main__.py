@@ -1,14 +1,27 @@
-"""Entry point to TGVmax destinations map UI."""
+"""Entry point to TGVmax destinations map UI and headless commands."""
 
+import os.path
 import sys
+import time
 
-from user_interface import LoadingUi, MainUi
+START_TIME = time.perf_counter()
+
+# Modules import each other by name, also when run with python -m
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+HEADLESS_COMMANDS = ["query", "flex", "batch", "subscribe", "refresh", \
+    "serve"]
 
 if __name__ == "__main__":
     try:
+        if len(sys.argv) > 1 and sys.argv[1] in HEADLESS_COMMANDS:
+            from query import main
+            sys.exit(main(sys.argv[1:]))
+
+        from user_interface import LoadingUi, MainUi
         loading_ui = LoadingUi()
         loading_ui.launch()
-        main_ui = MainUi()
+        main_ui = MainUi(START_TIME)
         main_ui.configure()
         main_ui.pack()
         main_ui.run()
@@ -0,0 +1,135 @@
+"""Generate results of many searches at once across a process pool."""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import hashlib
+import itertools
+import os
+import re
+import time
+
+from dataset import Dataset
+from query import run_query, write_results
+from search import make_user_entries
+
+FORMAT_SUFFIXES = {"html" : ".html", "payload" : ".json", "json" : ".json", \
+    "csv" : ".csv"}
+ONEWAY = "aller"
+REPORT_HEADER = ["origin", "date", "window", "mode", "rows", "ms", "path", \
+    "error"]
+
+# One search, stay_days is None for one-way searches
+BatchJob = namedtuple("BatchJob", ["origin", "date", "minh", "maxh", \
+    "stay_days"])
+BatchResult = namedtuple("BatchResult", ["job", "nb_rows", "elapsed_s", \
+    "path", "error"])
+
+# Dataset of a worker process, loaded once by init_worker
+WORKER_DATASET = None
+
+
+def make_jobs(origins, dates, windows, stays):
+    """Get jobs of the cartesian product of origins, dates, hours and stays.
+
+    Windows are (minh, maxh) tuples, stays are days or None for one-way.
+    """
+    return [BatchJob(origin, date, minh, maxh, stay) for origin, date, \
+        (minh, maxh), stay in itertools.product(origins, dates, windows, stays)]
+
+def job_mode(job):
+    """Get the mode name of a job, as used into its output path."""
+    return ONEWAY if job.stay_days is None else "sejour" + str(job.stay_days)
+
+def job_path(out_dir, job, out_format):
+    """Get the output file of a job, its own one per origin and search.
+
+    The origin directory ends with a hash of the exact name, as different
+    names can share the same sanitized one.
+    """
+    origin = re.sub(r"[^A-Za-z0-9]+", "_", job.origin).strip("_") + "_" + \
+        hashlib.sha1(job.origin.encode()).hexdigest()[:8]
+    name = job.date.isoformat() + "_" + str(job.minh) + "-" + str(job.maxh) + \
+        "_" + job_mode(job) + FORMAT_SUFFIXES[out_format]
+    return os.path.join(out_dir, origin, name)
+
+def job_entries(job):
+    """Get the user entries of a job."""
+    return_date = None
+    if job.stay_days is not None:
+        return_date = job.date + datetime.timedelta(days=job.stay_days)
+    return make_user_entries(job.origin, job.date, job.minh, job.maxh, \
+        return_date)
+
+def init_worker(snapshot_path, csv_coords, version):
+    """Load the dataset once per worker, columns are shared memory maps."""
+    global WORKER_DATASET
+    WORKER_DATASET = Dataset(snapshot_path, csv_coords, version)
+
+def run_job(job, out_dir, out_format):
+    """Run one job into a worker and write its results to its own file."""
+    start = time.perf_counter()
+    path = job_path(out_dir, job, out_format)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        user_entries = job_entries(job)
+        dataframe = run_query(WORKER_DATASET, user_entries)
+        write_results(WORKER_DATASET, user_entries, dataframe, out_format, \
+            path)
+        return BatchResult(job, len(dataframe), \
+            time.perf_counter() - start, path, None)
+    except Exception as err: # pylint: disable=broad-except
+        return BatchResult(job, 0, time.perf_counter() - start, None, \
+            repr(err))
+
+
+class BatchRunner:
+    """Run jobs across worker processes, all on one snapshot version.
+
+    The snapshot is pinned when the runner is created, a refresh published
+    meanwhile does not mix versions into one batch.
+    """
+
+    def __init__(self, store, csv_coords, workers=None):
+        """Pin the published snapshot version."""
+        self.version, self.snapshot_path = store.current()
+        self.csv_coords = csv_coords
+        self.workers = workers or os.cpu_count()
+
+    def run(self, jobs, out_dir, out_format="html", result_cb=None):
+        """Run every job, calling result_cb with each result as it ends.
+
+        Results are returned in jobs order with the overall elapsed time.
+        """
+        start = time.perf_counter()
+        results = []
+        chunksize = max(1, len(jobs) // (self.workers * 4))
+        with ProcessPoolExecutor(max_workers=self.workers, \
+                initializer=init_worker, initargs=(self.snapshot_path, \
+                self.csv_coords, self.version)) as executor:
+            for result in executor.map(run_job, jobs, \
+                    itertools.repeat(out_dir), itertools.repeat(out_format), \
+                    chunksize=chunksize):
+                results.append(result)
+                if result_cb is not None:
+                    result_cb(result)
+        return results, time.perf_counter() - start
+
+
+def report_row(result):
+    """Get the CSV report row of a job result."""
+    job = result.job
+    return [job.origin, job.date.isoformat(), \
+        str(job.minh) + "-" + str(job.maxh), job_mode(job), result.nb_rows, \
+        round(result.elapsed_s * 1000), result.path or "", result.error or ""]
+
+def summary(results, elapsed_s, workers):
+    """Get the overall throughput of a batch."""
+    failed = sum(1 for result in results if result.error is not None)
+    jobs_s = sum(result.elapsed_s for result in results)
+    return str(len(results)) + " jobs in " + str(round(elapsed_s, 2)) + \
+        " s with " + str(workers) + " workers, " + \
+        str(round(len(results) / elapsed_s, 1) if elapsed_s else 0) + \
+        " jobs/s, mean job " + \
+        str(round(jobs_s * 1000 / len(results)) if results else 0) + \
+        " ms, " + str(failed) + " failed"
@@ -0,0 +1,291 @@
+"""Memoize search results by user entries and dataset version."""
+
+from collections import OrderedDict
+import datetime
+import hashlib
+import os
+import pickle
+import threading
+
+from connections import MIN_TRANSFER_MIN
+from search import RETURN_MIN, hour_to_minutes
+from snapshot import DEPART_MIN, COL_ORIGIN, COL_DEST
+
+CACHE_ENTRIES = 64
+CACHE_BYTES = 256*1024*1024
+SPILL_BYTES = 1024*1024*1024
+SPILL_SUFFIX = ".pkl"
+
+# Cached entry fields
+FRAME = "frame"
+HTML = "html"
+NBYTES = "nbytes"
+
+
+def family_key(version, user_entries):
+    """Normalize everything but hours windows of user entries.
+
+    Transfers come last, only one-way searches look for connections.
+    """
+    return_date = user_entries["return"]["date"] if user_entries["mode"] \
+        else None
+    min_stay, max_stay = user_entries.get("min_stay"), \
+        user_entries.get("max_stay")
+    max_transfers = 0 if user_entries["mode"] else \
+        int(user_entries.get("max_transfers") or 0)
+    min_transfer = int(user_entries.get("min_transfer", MIN_TRANSFER_MIN)) \
+        if max_transfers else None
+    max_duration = user_entries.get("max_duration")
+    return (version, bool(user_entries["mode"]), user_entries["origin_city"], \
+        user_entries["departure"]["date"].isoformat(), \
+        return_date.isoformat() if return_date else None, \
+        None if min_stay is None else float(min_stay), \
+        None if max_stay is None else float(max_stay), \
+        None if max_duration is None else float(max_duration), \
+        bool(user_entries.get("isochrone")), user_entries.get("destination"), \
+        max_transfers, min_transfer)
+
+def window_key(user_entries):
+    """Normalize hours windows of user entries into minutes."""
+    window = (hour_to_minutes(user_entries["departure"]["minh"]), \
+        hour_to_minutes(user_entries["departure"]["maxh"]))
+    if not user_entries["mode"]:
+        return window + (None, None)
+    return window + (hour_to_minutes(user_entries["return"]["minh"]), \
+        hour_to_minutes(user_entries["return"]["maxh"]))
+
+def untouched(key, outbound, inbound):
+    """Check results of a key only read unchanged (city, date) partitions.
+
+    Searches with transfers may go through any station, they never are.
+    """
+    family = key[:-4]
+    roundtrip, origin, date, return_date = family[1:5]
+    if family[-2]:
+        return False
+    if (origin, datetime.date.fromisoformat(date).toordinal()) in outbound:
+        return False
+    return not roundtrip or (origin, \
+        datetime.date.fromisoformat(return_date).toordinal()) not in inbound
+
+def frame_nbytes(dataframe):
+    """Get the memory used by a results frame."""
+    return int(dataframe.memory_usage(deep=True).sum())
+
+
+class ResultCache:
+    """Least recently used search results, as frames and rendered maps.
+
+    Keys hold the dataset version, results of an older version are dropped
+    as soon as a newer one is seen, unless carried over to it from the diff
+    of both snapshots. A search whose hours windows fit into
+    a cached one is answered by filtering the cached frame. Entries evicted
+    from memory are pickled into spill_dir when it is given.
+    """
+
+    def __init__(self, max_entries=CACHE_ENTRIES, max_bytes=CACHE_BYTES, \
+            spill_dir=None, max_spill_bytes=SPILL_BYTES):
+        """Init an empty cache, within entries and bytes limits."""
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.entries = OrderedDict()
+        self.spilled = OrderedDict()
+        self.nbytes = 0
+        self.spill_nbytes = 0
+        self.version = None
+        self.lock = threading.Lock()
+        self.stats = {"hits" : 0, "subrange_hits" : 0, "misses" : 0}
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.clear_spill()
+
+    def accept(self, version):
+        """Check a version is current, invalidating older results if newer."""
+        if self.version is not None and version < self.version:
+            return False
+        if version != self.version:
+            self.entries.clear()
+            self.nbytes = 0
+            self.clear_spill()
+            self.version = version
+        return True
+
+    def carry_over(self, old_version, new_version, diff):
+        """Move results untouched by a snapshot diff to the new version.
+
+        Results on changed origins and dates are dropped, all of them when
+        the diff is unknown or when cities were added or removed.
+        """
+        if diff is None or not diff.same_cities:
+            return
+        outbound = diff.changed_partitions(COL_ORIGIN)
+        inbound = diff.changed_partitions(COL_DEST)
+        with self.lock:
+            if self.version != old_version:
+                return
+            entries = OrderedDict()
+            for key, entry in self.entries.items():
+                if untouched(key, outbound, inbound):
+                    entries[(new_version,) + key[1:]] = entry
+                else:
+                    self.nbytes -= entry[NBYTES]
+            spilled = OrderedDict()
+            for key, nbytes in self.spilled.items():
+                if untouched(key, outbound, inbound):
+                    new_key = (new_version,) + key[1:]
+                    os.replace(self.spill_path(key), self.spill_path(new_key))
+                    spilled[new_key] = nbytes
+                else:
+                    self.spill_nbytes -= nbytes
+                    os.remove(self.spill_path(key))
+            self.entries = entries
+            self.spilled = spilled
+            self.version = new_version
+
+    def get_frame(self, version, user_entries):
+        """Get a copy of cached results, None if not cached."""
+        key = family_key(version, user_entries) + window_key(user_entries)
+        with self.lock:
+            if not self.accept(version):
+                return None
+            entry = self.lookup(key)
+            if entry is not None:
+                self.stats["hits"] += 1
+                return entry[FRAME].copy()
+            dataframe = self.filter_superset(key)
+            if dataframe is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["subrange_hits"] += 1
+            self.insert(key, dataframe)
+            return dataframe.copy()
+
+    def put_frame(self, version, user_entries, dataframe):
+        """Cache the results of a search."""
+        key = family_key(version, user_entries) + window_key(user_entries)
+        with self.lock:
+            if self.accept(version):
+                self.insert(key, dataframe.copy())
+
+    def get_html(self, version, user_entries):
+        """Get the cached map of a search, None if not rendered yet."""
+        key = family_key(version, user_entries) + window_key(user_entries)
+        with self.lock:
+            if not self.accept(version):
+                return None
+            entry = self.lookup(key)
+            return None if entry is None else entry[HTML]
+
+    def put_html(self, version, user_entries, html):
+        """Cache the map of a search whose results are cached."""
+        key = family_key(version, user_entries) + window_key(user_entries)
+        with self.lock:
+            if not self.accept(version) or key not in self.entries:
+                return
+            entry = self.entries[key]
+            if entry[HTML] is None:
+                entry[HTML] = html
+                entry[NBYTES] += len(html)
+                self.nbytes += len(html)
+                self.evict()
+
+    def lookup(self, key):
+        """Get an entry from memory or spill, as most recently used."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if key not in self.spilled:
+            return None
+        self.spill_nbytes -= self.spilled.pop(key)
+        filepath = self.spill_path(key)
+        try:
+            with open(filepath, 'rb') as infile:
+                entry = pickle.load(infile)
+        except (OSError, pickle.UnpicklingError):
+            return None
+        finally:
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+        self.entries[key] = entry
+        self.nbytes += entry[NBYTES]
+        self.evict()
+        return entry
+
+    def filter_superset(self, key):
+        """Get results of a narrower hours window from a cached wider one.
+
+        Earliest journeys with transfers of a wider window may leave too
+        early for a narrower one, they are never filtered.
+        """
+        family, window = key[:-4], key[-4:]
+        if family[-2]:
+            return None
+        for cached_key, entry in reversed(self.entries.items()):
+            cached = cached_key[-4:]
+            if cached_key[:-4] != family or cached[0] > window[0] or \
+                    cached[1] < window[1]:
+                continue
+            if window[2] is not None and \
+                    (cached[2] > window[2] or cached[3] < window[3]):
+                continue
+            dataframe = entry[FRAME]
+            kept = (dataframe[DEPART_MIN] >= window[0]) & \
+                (dataframe[DEPART_MIN] < window[1])
+            if window[2] is not None:
+                kept &= (dataframe[RETURN_MIN] >= window[2]) & \
+                    (dataframe[RETURN_MIN] < window[3])
+            return dataframe[kept].reset_index(drop=True)
+        return None
+
+    def insert(self, key, dataframe):
+        """Add results as most recently used, then evict if over limits."""
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[NBYTES]
+        nbytes = frame_nbytes(dataframe)
+        self.entries[key] = {FRAME : dataframe, HTML : None, NBYTES : nbytes}
+        self.nbytes += nbytes
+        self.evict()
+
+    def evict(self):
+        """Drop least recently used entries over limits, spilling them."""
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries \
+                or self.nbytes > self.max_bytes):
+            key, entry = self.entries.popitem(last=False)
+            self.nbytes -= entry[NBYTES]
+            if self.spill_dir is not None:
+                self.spill(key, entry)
+
+    def spill_path(self, key):
+        """Get the spill file of an entry."""
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.spill_dir, name + SPILL_SUFFIX)
+
+    def spill(self, key, entry):
+        """Write an evicted entry to disk, within spill bytes limit."""
+        with open(self.spill_path(key), 'wb') as outfile:
+            pickle.dump(entry, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spilled[key] = entry[NBYTES]
+        self.spill_nbytes += entry[NBYTES]
+        while self.spill_nbytes > self.max_spill_bytes:
+            old_key, nbytes = self.spilled.popitem(last=False)
+            self.spill_nbytes -= nbytes
+            os.remove(self.spill_path(old_key))
+
+    def clear_spill(self):
+        """Delete every spilled entry."""
+        self.spilled.clear()
+        self.spill_nbytes = 0
+        if self.spill_dir is None:
+            return
+        for name in os.listdir(self.spill_dir):
+            if name.endswith(SPILL_SUFFIX):
+                os.remove(os.path.join(self.spill_dir, name))
+
+    def info(self):
+        """Get hits counters and sizes."""
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), \
+                nbytes=self.nbytes, spilled=len(self.spilled), \
+                version=self.version)
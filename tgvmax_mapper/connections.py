@@ -0,0 +1,148 @@
+"""Earliest arrivals through TGVmax connections, by connection scan."""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from snapshot import COL_ORIGIN, COL_DEST, COL_DATE, COL_DEPART, COL_ARRIVAL
+from snapshot import COL_DISPO, DATE, ORIGINE, DESTINATION, DEPART_TIME
+from snapshot import ARRIVAL_TIME, DATE_ORD, DEPART_MIN, ARRIVAL_MIN
+from snapshot import ORIGIN_CODE, DEST_CODE, MINUTES_PER_DAY
+from snapshot import ordinals_to_dates, minutes_to_times
+
+MIN_TRANSFER_MIN = 20
+MAX_TRANSFERS = 1
+UNREACHED = np.iinfo(np.int64).max // 2
+
+# Connections frame columns
+TRANSFERS = "Correspondances"
+VIA = "Via"
+VIA_SEPARATOR = " / "
+
+# Arrival minute and last connection of each station after each round
+ScanResult = namedtuple("ScanResult", ["arrivals", "parents", "rounds"])
+
+
+class ConnectionScan:
+    """Available trains of each day as connections sorted by departure.
+
+    A query scans the connections of its day once per train taken: each
+    round only boards at stations reached by previous rounds, which bounds
+    the number of transfers and keeps every round a vectorized pass.
+    """
+
+    def __init__(self, snapshot):
+        """Sort available journeys of the snapshot by date and departure."""
+        self.snapshot = snapshot
+        cols = snapshot.read_columns([COL_ORIGIN, COL_DEST, COL_DATE, \
+            COL_DEPART, COL_ARRIVAL, COL_DISPO])
+        rows = np.flatnonzero(cols[COL_DISPO])
+        rows = rows[np.lexsort((cols[COL_DEPART][rows], cols[COL_DATE][rows]))]
+        self.dates = np.asarray(cols[COL_DATE][rows])
+        self.origins = cols[COL_ORIGIN][rows].astype(np.int64)
+        self.dests = cols[COL_DEST][rows].astype(np.int64)
+        self.departs = cols[COL_DEPART][rows].astype(np.int64)
+        arrivals = cols[COL_ARRIVAL][rows].astype(np.int64)
+        # Trains arriving after midnight
+        self.arrivals = np.where(arrivals < self.departs, \
+            arrivals + MINUTES_PER_DAY, arrivals)
+
+    def day_bounds(self, date):
+        """Get the connections slice of one date ordinal."""
+        return np.searchsorted(self.dates, date, side='left'), \
+            np.searchsorted(self.dates, date, side='right')
+
+    def scan(self, origin_code, date, min_minute=0, \
+            max_minute=MINUTES_PER_DAY, min_transfer=MIN_TRANSFER_MIN, \
+            max_transfers=MAX_TRANSFERS):
+        """Get earliest arrivals from an origin leaving in [min, max) minutes.
+
+        Parents are indices of connections into the day slice, -1 where a
+        station is not reached, rounds the round a station was reached at.
+        """
+        start, end = self.day_bounds(date)
+        origins, dests = self.origins[start:end], self.dests[start:end]
+        departs, arrivals = self.departs[start:end], self.arrivals[start:end]
+        nb_cities = len(self.snapshot.cities)
+        best = np.full(nb_cities, UNREACHED, dtype=np.int64)
+        parent = np.full(nb_cities, -1, dtype=np.int64)
+        reached_round = np.full(nb_cities, -1, dtype=np.int64)
+        result = ScanResult([], [], [])
+
+        for round_no in range(max_transfers + 1):
+            if round_no == 0:
+                ready = (origins == origin_code) & (departs >= min_minute) & \
+                    (departs < max_minute)
+            else:
+                ready = (origins != origin_code) & \
+                    (best[origins] + min_transfer <= departs)
+            ready &= dests != origin_code
+            candidates = np.flatnonzero(ready)
+            # Earliest arrival first, then keep the first one of each station
+            candidates = candidates[np.argsort(arrivals[candidates], \
+                kind='stable')]
+            stations, firsts = np.unique(dests[candidates], return_index=True)
+            candidates = candidates[firsts]
+            improved = arrivals[candidates] < best[stations]
+            stations, candidates = stations[improved], candidates[improved]
+
+            best = best.copy()
+            parent = parent.copy()
+            reached_round = reached_round.copy()
+            best[stations] = arrivals[candidates]
+            parent[stations] = candidates
+            reached_round[stations] = round_no
+            result.arrivals.append(best)
+            result.parents.append(parent)
+            result.rounds.append(reached_round)
+            if not len(stations):
+                break
+        return result
+
+    def journeys(self, origin_code, date, min_minute=0, \
+            max_minute=MINUTES_PER_DAY, min_transfer=MIN_TRANSFER_MIN, \
+            max_transfers=MAX_TRANSFERS):
+        """Get one earliest journey per reached station as a dataframe.
+
+        The departure is the one of the first train, Via lists the transfer
+        stations in travel order.
+        """
+        result = self.scan(origin_code, date, min_minute, max_minute, \
+            min_transfer, max_transfers)
+        start = self.day_bounds(date)[0]
+        stations = np.flatnonzero(result.parents[-1] >= 0)
+        first_departs = np.empty(len(stations), dtype=np.int64)
+        transfers = np.empty(len(stations), dtype=np.int64)
+        vias = []
+        for pos, station in enumerate(stations):
+            legs = []
+            node, round_no = station, len(result.parents) - 1
+            while True:
+                leg = result.parents[round_no][node]
+                legs.append(leg)
+                previous = self.origins[start + leg]
+                if previous == origin_code:
+                    break
+                node, round_no = previous, result.rounds[round_no][node] - 1
+            first_departs[pos] = self.departs[start + legs[-1]]
+            transfers[pos] = len(legs) - 1
+            vias.append(VIA_SEPARATOR.join(self.snapshot.cities[ \
+                self.dests[start + leg]] for leg in reversed(legs[1:])))
+
+        arrivals = result.arrivals[-1][stations]
+        return pd.DataFrame(data={
+            DATE : ordinals_to_dates(np.full(len(stations), date)),
+            ORIGINE : self.snapshot.decode_cities( \
+                np.full(len(stations), origin_code)),
+            DESTINATION : self.snapshot.decode_cities(stations),
+            DEPART_TIME : minutes_to_times(first_departs),
+            ARRIVAL_TIME : minutes_to_times(arrivals % MINUTES_PER_DAY),
+            DATE_ORD : np.full(len(stations), date, dtype=np.int32),
+            DEPART_MIN : first_departs,
+            ARRIVAL_MIN : arrivals,
+            ORIGIN_CODE : np.full(len(stations), origin_code, dtype=np.int16),
+            DEST_CODE : stations.astype(np.int16),
+            TRANSFERS : transfers,
+            VIA : vias
+        })
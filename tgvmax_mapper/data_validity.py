@@ -5,6 +5,9 @@ import json
 import time
 
 TIMESTAMP_LABEL = 'timestamp'
+ETAG_LABEL = 'etag'
+LAST_MODIFIED_LABEL = 'last_modified'
+VALIDATORS_SUFFIX = '_validators.json'
 
 class TimeKeeper:
     """Manage informations about data validity."""
@@ -13,6 +16,8 @@ class TimeKeeper:
         """Init Time Keeper for further data validity checking."""
         self.update_tms_path = update_tms_path
         self.update_delay_s = update_delay_s
+        self.validators_path = os.path.splitext(update_tms_path)[0] + \
+            VALIDATORS_SUFFIX
 
     def write_cur_tms(self):
         """Write current timestamp into json file."""
@@ -32,3 +37,28 @@ class TimeKeeper:
         if not os.path.isfile(self.update_tms_path):
             return True
         return time.time() > self.get_updt_tms() + self.update_delay_s
+
+    def write_validators(self, etag, last_modified):
+        """Write HTTP validators of the downloaded data into json file."""
+        data = {}
+        data[ETAG_LABEL] = etag
+        data[LAST_MODIFIED_LABEL] = last_modified
+        with open(self.validators_path, 'w') as outfile:
+            json.dump(data, outfile)
+
+    def get_validators(self):
+        """Read HTTP validators from json file, empty if never written."""
+        if not os.path.isfile(self.validators_path):
+            return {}
+        with open(self.validators_path) as infile:
+            return json.load(infile)
+
+    def get_conditional_headers(self):
+        """Get HTTP headers asking data only if modified since last update."""
+        validators = self.get_validators()
+        headers = {}
+        if validators.get(ETAG_LABEL):
+            headers['If-None-Match'] = validators[ETAG_LABEL]
+        if validators.get(LAST_MODIFIED_LABEL):
+            headers['If-Modified-Since'] = validators[LAST_MODIFIED_LABEL]
+        return headers
@@ -0,0 +1,48 @@
+"""Keep TGVmax data loaded for a whole session."""
+
+import numpy as np
+import pandas as pd
+
+from connections import ConnectionScan
+from index import JourneyIndex
+from reachability import ReachabilityIndex
+from snapshot import SnapshotReader, COLUMNS_DTYPES
+
+CITY = "CITY"
+LAT = "LAT"
+LON = "LON"
+
+
+class Dataset:
+    """Journeys snapshot and cities coordinates, loaded once and shared."""
+
+    def __init__(self, snapshot_path, csv_coord_path, version=0):
+        """Open the snapshot columns and indexes, load cities coordinates."""
+        self.version = version
+        self.snapshot = SnapshotReader(snapshot_path)
+        self.snapshot.read_columns(COLUMNS_DTYPES.keys())
+        self.index = JourneyIndex(self.snapshot)
+        self.reachability = ReachabilityIndex(self.snapshot)
+        self.coords = self.load_coords(csv_coord_path)
+        self.connections = None
+
+    def load_current(store, csv_coord_path):
+        """Load the snapshot version currently published into a store."""
+        version, snapshot_path = store.current()
+        return Dataset(snapshot_path, csv_coord_path, version)
+
+    def load_coords(self, csv_coord_path):
+        """Get (lat, lon) of each city indexed by its code, NaN if unknown."""
+        df_coord = pd.read_csv(csv_coord_path)
+        coords = np.full((len(self.snapshot.cities), 2), np.nan)
+        codes = df_coord[CITY].map(self.snapshot.city_codes)
+        known = codes.notna()
+        coords[codes[known].astype(np.int64)] = \
+            df_coord.loc[known, [LAT, LON]].round(6).values
+        return coords
+
+    def connection_scan(self):
+        """Get journeys sorted for connection scans, sorted on first use."""
+        if self.connections is None:
+            self.connections = ConnectionScan(self.snapshot)
+        return self.connections
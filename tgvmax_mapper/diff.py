@@ -0,0 +1,56 @@
+"""Compare two journeys snapshots row by row."""
+
+import numpy as np
+import pandas as pd
+
+from snapshot import COL_ORIGIN, COL_DEST, COL_DATE, COL_DEPART, COL_DISPO
+from snapshot import COL_TRAIN
+
+KEY_COLUMNS = [COL_TRAIN, COL_DATE, COL_ORIGIN, COL_DEST, COL_DEPART]
+MERGE_STATUS = "_merge"
+
+
+class SnapshotDiff:
+    """Added, removed and changed journeys between two snapshots.
+
+    Journeys are keyed by (train, date, origin, destination, departure),
+    a journey whose availability flips is reported as changed. City codes
+    of both snapshots match when same_cities is True.
+    """
+
+    def __init__(self, old_snapshot, new_snapshot):
+        """Diff the old snapshot against the new one."""
+        self.cities = sorted(set(old_snapshot.cities) | set(new_snapshot.cities))
+        self.same_cities = list(old_snapshot.cities) == \
+            list(new_snapshot.cities)
+        old = self.keyed_frame(old_snapshot)
+        new = self.keyed_frame(new_snapshot)
+        merged = old.merge(new, how='outer', on=KEY_COLUMNS, \
+            suffixes=("_old", "_new"), indicator=True)
+        status = merged[MERGE_STATUS]
+        self.removed = merged[status == 'left_only'][KEY_COLUMNS]
+        self.added = merged[status == 'right_only'][KEY_COLUMNS]
+        both = merged[status == 'both']
+        self.changed = both[both[COL_DISPO + "_old"] != \
+            both[COL_DISPO + "_new"]][KEY_COLUMNS]
+
+    def keyed_frame(self, snapshot):
+        """Get key columns and availability with cities coded on both sides."""
+        cols = snapshot.read_columns(KEY_COLUMNS + [COL_DISPO])
+        remap = pd.Categorical(snapshot.cities, categories=self.cities).codes
+        frame = pd.DataFrame(data={name : np.asarray(cols[name]) \
+            for name in KEY_COLUMNS + [COL_DISPO]})
+        for name in [COL_ORIGIN, COL_DEST]:
+            frame[name] = remap[frame[name].values]
+        return frame.drop_duplicates(subset=KEY_COLUMNS)
+
+    def __len__(self):
+        """Number of added, removed and changed journeys."""
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def changed_partitions(self, city_column):
+        """Get (city, date ordinal) partitions touched, by origin or dest."""
+        touched = pd.concat([self.added, self.removed, self.changed])
+        pairs = touched[[city_column, COL_DATE]].drop_duplicates()
+        return {(self.cities[city], int(date)) \
+            for city, date in zip(pairs[city_column], pairs[COL_DATE])}
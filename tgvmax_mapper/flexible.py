@@ -0,0 +1,201 @@
+"""Flexible dates search, availability of one origin over every date."""
+
+from collections import namedtuple
+import html
+
+import numpy as np
+import pandas as pd
+
+from index import OUTBOUND, RETURN
+from search import MapCreator, hour_to_minutes, DATE, DESTINATION, LAT, LON, \
+    HTML_DEFAULT_ZOOM, HTML_TILES, TRAVEL_INFOS
+from snapshot import COL_ORIGIN, COL_DEST, COL_DATE, COL_DISPO
+from snapshot import ordinals_to_dates
+
+OUTBOUNDS = "Allers"
+ROUNDTRIPS = "Allers_retours"
+DAYS = "Jours_disponibles"
+BEST_DATES = 3
+
+# Search stages, reported before running
+STAGE_MATRIX = "Calcul des disponibilités"
+STAGE_DISPLAY = "Création de la carte"
+
+HTML_LAYER = "Meilleures dates"
+TABLE_STYLE = "position:absolute;bottom:0;left:0;right:0;max-height:40%;" + \
+    "overflow:auto;z-index:1000;background:white;font:11px sans-serif;"
+CELL_COLOR = "rgba(200,30,30,{:.2f})"
+
+# Dates as day ordinals, counts as destination x date arrays over cities
+DateMatrix = namedtuple("DateMatrix", ["dates", "outbounds", "roundtrips"])
+
+
+def make_flex_entries(origin_city, minh, maxh, stay_days=None, \
+        return_minh=3, return_maxh=23):
+    """Build flexible search user entries, round-trip when a stay is given.
+
+    Hours are whole hours or HH:MM times, the stay is in whole days.
+    """
+    if stay_days is not None and int(stay_days) < 1:
+        raise ValueError("stay must be at least one day")
+    return {
+        "mode" : stay_days is not None,
+        "origin_city" : origin_city,
+        "departure" : {"minh" : minh, "maxh" : maxh},
+        "return" : {"minh" : return_minh, "maxh" : return_maxh},
+        "stay_days" : None if stay_days is None else int(stay_days)
+    }
+
+
+class FlexibleSearch:
+    """Count available trains of one origin for every destination and date.
+
+    Each direction is one slice of the journeys index over all dates, so
+    the whole booking window costs about one single date search.
+    """
+
+    def __init__(self, dataset, html_filepath=None):
+        """Init the search with the session dataset."""
+        self.dataset = dataset
+        self.html_filepath = html_filepath
+
+    def counts(self, direction, city_code, min_minute, max_minute):
+        """Get available trains per other city and date from or to a city."""
+        index = self.dataset.index
+        snapshot = self.dataset.snapshot
+        rows = index.lookup_dates(direction, city_code, min_minute, max_minute)
+        rows = rows[snapshot.column(COL_DISPO)[rows]]
+        other = COL_DEST if direction == OUTBOUND else COL_ORIGIN
+        cells = snapshot.column(other)[rows].astype(np.int64) * \
+            index.nb_days + (snapshot.column(COL_DATE)[rows] - index.first_date)
+        return np.bincount(cells, minlength=len(snapshot.cities) * \
+            index.nb_days).reshape(len(snapshot.cities), index.nb_days)
+
+    def compute(self, user_entries):
+        """Get outbound and round-trip counts over every date.
+
+        A round trip leaving on a date returns stay_days later, its count
+        is the number of (outbound, return) pairs.
+        """
+        index = self.dataset.index
+        dates = index.first_date + np.arange(index.nb_days)
+        city_code = self.dataset.snapshot.city_code(user_entries["origin_city"])
+        if city_code is None:
+            print("ERROR : unknown departure city " + \
+                user_entries["origin_city"])
+            empty = np.zeros((len(self.dataset.snapshot.cities), \
+                index.nb_days), dtype=np.int64)
+            return DateMatrix(dates, empty, empty if user_entries["mode"] \
+                else None)
+
+        outbounds = self.counts(OUTBOUND, city_code, \
+            hour_to_minutes(user_entries["departure"]["minh"]), \
+            hour_to_minutes(user_entries["departure"]["maxh"]))
+        if not user_entries["mode"]:
+            return DateMatrix(dates, outbounds, None)
+        returns = self.counts(RETURN, city_code, \
+            hour_to_minutes(user_entries["return"]["minh"]), \
+            hour_to_minutes(user_entries["return"]["maxh"]))
+        stay = user_entries["stay_days"]
+        roundtrips = np.zeros_like(outbounds)
+        if stay < index.nb_days:
+            roundtrips[:, :-stay] = outbounds[:, :-stay] * returns[:, stay:]
+        return DateMatrix(dates, outbounds, roundtrips)
+
+    def scores(self, matrix):
+        """Get the counts ranking dates, round trips if searched."""
+        return matrix.outbounds if matrix.roundtrips is None \
+            else matrix.roundtrips
+
+    def frame(self, matrix):
+        """Get non empty (destination, date) cells as a dataframe."""
+        cities, days = np.nonzero(self.scores(matrix))
+        data = {
+            DESTINATION : self.dataset.snapshot.decode_cities(cities),
+            DATE : ordinals_to_dates(matrix.dates[days]),
+            OUTBOUNDS : matrix.outbounds[cities, days]
+        }
+        if matrix.roundtrips is not None:
+            data[ROUNDTRIPS] = matrix.roundtrips[cities, days]
+        return pd.DataFrame(data=data)
+
+    def best_dates(self, matrix, count=BEST_DATES):
+        """Get each reachable destination with its best dates.
+
+        Dates are ranked by count, then earliest first.
+        """
+        scores = self.scores(matrix)
+        cities = np.flatnonzero(scores.any(axis=1))
+        ranks = np.argsort(-scores[cities], axis=1, kind='stable')[:, :count]
+        best = np.take_along_axis(scores[cities], ranks, axis=1)
+        dates = ordinals_to_dates(matrix.dates[ranks])
+        infos = pd.Series([" / ".join(day + " (" + str(nb) + ")" \
+            for day, nb in zip(days, nbs) if nb) \
+            for days, nbs in zip(dates, best)], dtype=object)
+        coords = self.dataset.coords[cities]
+        return pd.DataFrame(data={
+            DESTINATION : self.dataset.snapshot.decode_cities(cities),
+            LAT : np.nan_to_num(coords[:, 0]),
+            LON : np.nan_to_num(coords[:, 1]),
+            TRAVEL_INFOS : "Meilleures dates : " + infos,
+            DAYS : (scores[cities] > 0).sum(axis=1)
+        })
+
+    def table_html(self, matrix):
+        """Get the destination x date counts as an HTML heatmap table."""
+        scores = self.scores(matrix)
+        cities = np.flatnonzero(scores.any(axis=1))
+        cities = cities[np.argsort(-scores[cities].sum(axis=1), kind='stable')]
+        top = max(int(scores.max()), 1)
+        days = [day[8:10] + "/" + day[5:7] \
+            for day in ordinals_to_dates(matrix.dates)]
+        lines = ["<table><tr><th></th>" + \
+            "".join("<th>" + day + "</th>" for day in days) + "</tr>"]
+        for city, name in zip(cities, \
+                self.dataset.snapshot.decode_cities(cities)):
+            lines.append("<tr><th>" + html.escape(name) + "</th>" + "".join( \
+                "<td style=\"background:" + CELL_COLOR.format(nb / top) + \
+                "\">" + (str(nb) if nb else "") + "</td>" \
+                for nb in scores[city]) + "</tr>")
+        lines.append("</table>")
+        return "\n".join(lines)
+
+    def render(self, matrix, origin):
+        """Build the map of best dates per destination, over the heatmap.
+
+        Without any destination, only the origin and the table are drawn.
+        """
+        import folium
+
+        map_creator = MapCreator(None, self.dataset)
+        origin_coords = map_creator.get_origine_geoloc(origin)
+        destmap = folium.Map(location=origin_coords, \
+            zoom_start=HTML_DEFAULT_ZOOM, tiles=HTML_TILES)
+        folium.Marker(location=origin_coords, tooltip=origin, \
+            icon=folium.Icon(color="green", icon="info-sign")).add_to(destmap)
+        best_dates = self.best_dates(matrix)
+        if not best_dates.empty:
+            folium.GeoJson(map_creator.destinations_geojson(best_dates), \
+                name=HTML_LAYER, marker=folium.Marker(icon=folium.Icon( \
+                    color="red", icon="calendar")), \
+                tooltip=folium.GeoJsonTooltip(fields=[DESTINATION, \
+                    TRAVEL_INFOS], labels=False) \
+            ).add_to(destmap)
+        destmap.get_root().html.add_child(folium.Element( \
+            "<div style=\"" + TABLE_STYLE + "\">" + self.table_html(matrix) + \
+            "</div>"))
+        return destmap
+
+    def generate(self, user_entries, progress_cb=None):
+        """Compute the date matrix and save its map into HTML format.
+
+        progress_cb is called with each stage name before it runs.
+        """
+        if progress_cb is not None:
+            progress_cb(STAGE_MATRIX)
+        matrix = self.compute(user_entries)
+        if progress_cb is not None:
+            progress_cb(STAGE_DISPLAY)
+        self.render(matrix, user_entries["origin_city"]).save( \
+            self.html_filepath)
+        return self.best_dates(matrix)
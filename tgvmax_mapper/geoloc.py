@@ -1,100 +1,451 @@
 """Manage cities geolocalisation coordinates."""
 
+import bisect
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import csv
 import os
+import re
+import threading
 import time
+import unicodedata
 
+import numpy as np
 import pandas as pd
-from geopy.geocoders import Nominatim
 
-CSV_TEMPGEOLOC = "resources/tempgeoloc.csv"
+from snapshot import SnapshotReader, COL_ORIGIN, COL_DEST
+
+CSV_GEOCODE_CACHE = "resources/geocode_cache.csv"
+CSV_ALIASES = "resources/city_aliases.csv"
+CSV_GAZETTEER_ALIASES = "resources/gazetteer_aliases.csv"
+GAZETTEER_PATH = "resources/gazetteer.txt"
+USER_AGENT = "tgvmax_mapper"
+GEOCODE_WORKERS = 4
+GEOCODE_RATE_S = 1.0
+GEOCODE_BURST = 1
+
+# GeoNames dump columns
+GEONAMES_NAME = 1
+GEONAMES_ASCIINAME = 2
+GEONAMES_ALTNAMES = 3
+GEONAMES_LAT = 4
+GEONAMES_LON = 5
+GEONAMES_FEATURE_CLASS = 6
+GEONAMES_COUNTRY = 8
+GEONAMES_POPULATION = 14
+
+# Gazetteer places kept: populated places and spots, stations included
+GAZETTEER_FEATURE_CLASSES = ["P", "S"]
+# France first, then its neighbours with stations across the border
+HOME_COUNTRY = "FR"
+GAZETTEER_COUNTRIES = [HOME_COUNTRY, "BE", "LU", "DE", "CH", "IT", "ES", \
+    "MC", "AD"]
+# Times the population a partial match needs over any other place
+PREFIX_DOMINANCE = 10
+# Abbreviations of SNCF labels, expanded on station and place names
+ABBREVIATIONS = {"ST" : "SAINT", "STE" : "SAINTE", "MT" : "MONT", \
+    "ND" : "NOTRE DAME"}
+# Words never matched alone once station names are truncated
+GENERIC_WORDS = ["GARE", "AEROPORT", "SAINT", "SAINTE", "MONT", "LA", "LE", \
+    "LES"]
+
+Location = namedtuple("Location", ["latitude", "longitude"])
+
+
+def normalize_name(name):
+    """Normalize a place name into upper case words, abbreviations expanded."""
+    ascii_name = unicodedata.normalize("NFKD", name) \
+        .encode("ascii", "ignore").decode("ascii")
+    words = re.sub(r"[^A-Z0-9]+", " ", ascii_name.upper()).split()
+    return " ".join(ABBREVIATIONS.get(word, word) for word in words)
+
+def dominates(rank, other_rank):
+    """Check a place ranks clearly above another one sharing its name.
+
+    Ranks are (home country, population), a French place dominates any
+    foreign one.
+    """
+    if other_rank is None:
+        return True
+    (home, population), (other_home, other_population) = rank, other_rank
+    return home != other_home or population > PREFIX_DOMINANCE * \
+        other_population
+
+def load_aliases(csv_aliases):
+    """Read a station;name alias table by normalized station, empty if none."""
+    if not os.path.isfile(csv_aliases):
+        return {}
+    with open(csv_aliases, newline='', encoding='utf-8') as infile:
+        reader = csv.reader(infile, delimiter=';')
+        next(reader, None)
+        return {normalize_name(station) : name for station, name in reader}
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting calls rate."""
+
+    def __init__(self, rate_s, capacity):
+        """Init bucket refilled with rate_s tokens per second."""
+        self.rate_s = rate_s
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for a token then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, \
+                    self.tokens + (now - self.last) * self.rate_s)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_s = (1 - self.tokens) / self.rate_s
+            time.sleep(wait_s)
+
+
+class Geocoder:
+    """Geocoder backend interface."""
+
+    def geocode(self, name):
+        """Get a location with latitude and longitude, None if not found."""
+        raise NotImplementedError
+
+    def report(self):
+        """Get lines about lookups done so far, empty if nothing to tell."""
+        return []
+
+
+class GazetteerGeocoder(Geocoder):
+    """Offline geocoder over a local gazetteer loaded into memory.
+
+    Reads a GeoNames dump (tab separated, alternate names included), kept
+    to places and stations of France and its neighbours, or a CSV file
+    with CITY, LAT and LON columns like city_coords.csv. Places sharing a
+    name are ranked French first, then by population. Lookups try the
+    exact name, the normalized name, then names starting with it, then the
+    name without its trailing words, the last two only when one place
+    clearly dominates the others. Other names are left to the next
+    geocoder rather than guessed.
+    """
+
+    def __init__(self, gazetteer_path, aliases=None):
+        """Load the gazetteer and build its indexes.
+
+        aliases maps normalized stations to names as found in the gazetteer.
+        """
+        self.aliases = aliases or {}
+        self.exact = {}
+        self.normalized = {}
+        # Best rank of another place under each normalized name
+        self.runners_up = {}
+        for names, location, rank in self.read(gazetteer_path):
+            for name in names:
+                GazetteerGeocoder.keep(self.exact, name, rank, location)
+                self.keep_normalized(normalize_name(name), rank, location)
+        self.sorted_keys = sorted(self.normalized)
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def keep(index, key, rank, location):
+        """Index a place under a name unless a better ranked one has it."""
+        if key not in index or rank > index[key][0]:
+            index[key] = (rank, location)
+
+    def keep_normalized(self, key, rank, location):
+        """Index a place under a normalized name, with the runner-up rank."""
+        if key not in self.normalized:
+            self.normalized[key] = (rank, location)
+            return
+        best_rank, best_location = self.normalized[key]
+        if location == best_location:
+            self.normalized[key] = (max(rank, best_rank), location)
+        elif rank > best_rank:
+            self.normalized[key] = (rank, location)
+            self.runners_up[key] = best_rank
+        elif self.runners_up.get(key) is None or rank > self.runners_up[key]:
+            self.runners_up[key] = rank
+
+    def read(self, gazetteer_path):
+        """Yield names, location and (home country, population) of places."""
+        with open(gazetteer_path, newline='', encoding='utf-8') as infile:
+            if gazetteer_path.endswith(".csv"):
+                for row in csv.DictReader(infile):
+                    yield [row["CITY"]], Location(float(row["LAT"]), \
+                        float(row["LON"])), (True, 0)
+                return
+            for row in csv.reader(infile, delimiter='\t', \
+                    quoting=csv.QUOTE_NONE):
+                if row[GEONAMES_FEATURE_CLASS] not in \
+                        GAZETTEER_FEATURE_CLASSES or \
+                        row[GEONAMES_COUNTRY] not in GAZETTEER_COUNTRIES:
+                    continue
+                names = [row[GEONAMES_NAME], row[GEONAMES_ASCIINAME]] + \
+                    [alt for alt in row[GEONAMES_ALTNAMES].split(",") if alt]
+                rank = (row[GEONAMES_COUNTRY] == HOME_COUNTRY, \
+                    int(row[GEONAMES_POPULATION] or 0))
+                yield names, Location(float(row[GEONAMES_LAT]), \
+                    float(row[GEONAMES_LON])), rank
+
+    def lookup_prefix(self, key):
+        """Get the best ranked place with a name starting with key.
+
+        None if another place is as well ranked, French or not like it and
+        not PREFIX_DOMINANCE times less populated.
+        """
+        places = {}
+        pos = bisect.bisect_left(self.sorted_keys, key)
+        while pos < len(self.sorted_keys) and \
+                self.sorted_keys[pos].startswith(key):
+            rank, location = self.normalized[self.sorted_keys[pos]]
+            places[location] = max(rank, places.get(location, rank))
+            pos += 1
+        ranked = sorted(places.items(), key=lambda place: place[1], \
+            reverse=True)
+        if not ranked or (len(ranked) > 1 and \
+                not dominates(ranked[0][1], ranked[1][1])):
+            return None
+        return ranked[0][0]
+
+    def lookup_truncated(self, key):
+        """Get the place named as key without its trailing words.
+
+        The longest such name wins, when not a generic word and when its
+        place dominates the others of that name.
+        """
+        words = key.split()
+        for length in range(len(words) - 1, 0, -1):
+            name = " ".join(words[:length])
+            if name in self.normalized and name not in GENERIC_WORDS and \
+                    dominates(self.normalized[name][0], \
+                    self.runners_up.get(name)):
+                return self.normalized[name][1]
+        return None
+
+    def geocode(self, name):
+        """Geocode a name from memory only."""
+        location = self.lookup(name)
+        with self.lock:
+            self.lookups += 1
+            self.hits += location is not None
+        return location
+
+    def lookup(self, name):
+        """Look a name up by decreasing confidence."""
+        name = self.aliases.get(normalize_name(name), name)
+        if name in self.exact:
+            return self.exact[name][1]
+        key = normalize_name(name)
+        if key in self.normalized:
+            return self.normalized[key][1]
+        location = self.lookup_prefix(key + " ")
+        if location is None:
+            location = self.lookup_truncated(key)
+        return location
+
+    def report(self):
+        """Get the share of names found offline."""
+        if not self.lookups:
+            return []
+        return ["Gazetteer : " + str(self.hits) + "/" + str(self.lookups) + \
+            " names found offline (" + \
+            str(round(self.hits / self.lookups * 100, 1)) + " %)"]
+
+
+class NominatimGeocoder(Geocoder):
+    """Online geocoder through Nominatim, rate limited as it requests."""
+
+    def __init__(self, rate_s=GEOCODE_RATE_S, burst=GEOCODE_BURST, \
+            aliases=None):
+        """Init one shared Nominatim client.
+
+        aliases maps normalized stations to queries Nominatim resolves.
+        """
+        from geopy.geocoders import Nominatim
+        self.client = Nominatim(user_agent=USER_AGENT)
+        self.bucket = TokenBucket(rate_s, burst)
+        self.aliases = aliases or {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def geocode(self, name):
+        """Geocode a name with one network call."""
+        self.bucket.acquire()
+        with self.lock:
+            self.requests += 1
+        return self.client.geocode(self.aliases.get(normalize_name(name), \
+            name))
+
+    def report(self):
+        """Get the number of rate limited requests."""
+        if not self.requests:
+            return []
+        return ["Nominatim : " + str(self.requests) + " requests"]
+
+
+class ChainGeocoder(Geocoder):
+    """Try geocoder backends in order, for instance offline then online."""
+
+    def __init__(self, geocoders):
+        """Init with backends by priority."""
+        self.geocoders = geocoders
+
+    def geocode(self, name):
+        """Get the first location found by a backend."""
+        for geocoder in self.geocoders:
+            location = geocoder.geocode(name)
+            if location is not None:
+                return location
+        return None
+
+    def report(self):
+        """Get lines of every backend."""
+        return [line for geocoder in self.geocoders \
+            for line in geocoder.report()]
+
+
+def default_geocoder(gazetteer_path=GAZETTEER_PATH, fallback=True):
+    """Get the offline gazetteer geocoder if any, Nominatim as fallback.
+
+    Each backend has its own alias table, written for its own names.
+    """
+    geocoders = []
+    if os.path.isfile(gazetteer_path):
+        geocoders.append(GazetteerGeocoder(gazetteer_path, \
+            load_aliases(CSV_GAZETTEER_ALIASES)))
+    if fallback or not geocoders:
+        geocoders.append(NominatimGeocoder(aliases=load_aliases(CSV_ALIASES)))
+    return ChainGeocoder(geocoders)
+
+
+class GeocodeCache:
+    """Append-only CSV cache of geocoded names, read once when opened.
+
+    Only found places are cached, names not found are geocoded again next
+    time, after a timeout or once an alias was added.
+    """
+
+    def __init__(self, csv_path):
+        """Load every cached name, skipping not found ones of older caches."""
+        self.csv_path = csv_path
+        self.lock = threading.Lock()
+        self.coords = {}
+        if os.path.isfile(csv_path):
+            with open(csv_path, newline='') as infile:
+                for name, lat, lon in csv.reader(infile, delimiter=';'):
+                    if lat:
+                        self.coords[name] = (float(lat), float(lon))
+
+    def __contains__(self, name):
+        """Check if a normalized name was already geocoded."""
+        return name in self.coords
+
+    def get(self, name):
+        """Get cached (lat, lon) of a normalized name, None if not found."""
+        return self.coords.get(name)
+
+    def add(self, name, coords):
+        """Cache and append the (lat, lon) found for a normalized name."""
+        with self.lock:
+            self.coords[name] = coords
+            with open(self.csv_path, 'a', newline='') as outfile:
+                csv.writer(outfile, delimiter=';').writerow([name] + \
+                    list(coords))
+
+
+class GeocodeEngine:
+    """Geocode names concurrently through a cache.
+
+    Online backends rate limit their own calls, so offline lookups are
+    never slowed down by them.
+    """
+
+    def __init__(self, geocoder, cache, workers=GEOCODE_WORKERS):
+        """Init engine with a shared geocoder client having a geocode method."""
+        self.geocoder = geocoder
+        self.cache = cache
+        self.workers = workers
+
+    def geocode_one(self, name):
+        """Geocode one normalized name, caching it if found."""
+        loc = self.geocoder.geocode(name)
+        if loc is None:
+            return None
+        coords = (loc.latitude, loc.longitude)
+        self.cache.add(name, coords)
+        return coords
+
+    def geocode_all(self, names):
+        """Get (lat, lon) or None for each name, geocoding uncached ones."""
+        keys = {name : normalize_name(name) for name in names}
+        missing = sorted(set(keys.values()) - set(self.cache.coords))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for done, _ in enumerate(executor.map(self.geocode_one, missing)):
+                print(str(round((done + 1)/len(missing)*100, 2))+" %")
+        return {name : self.cache.get(key) for name, key in keys.items()}
+
 
 class GeolocUpdater:
     """Fill the CSV file with associating a city with its GPS coordinates"""
 
-    def __init__(self, csv_src, csv_geoloc_temp, csv_dest):
-        """Init the cities geolocalisation updater."""
+    def __init__(self, csv_src, csv_geocode_cache, csv_dest, geocoder=None):
+        """Init the cities geolocalisation updater.
+
+        geocoder defaults to the offline gazetteer if present, with one
+        shared Nominatim client as fallback. csv_src is the snapshot
+        directory read when generate is not given one.
+        """
         self.csv_src = csv_src
-        self.csv_geoloc_temp = csv_geoloc_temp
+        self.csv_geocode_cache = csv_geocode_cache
+        self.geocoder = geocoder
         self.csv_dest = csv_dest
 
-    def get_explicit_name(dest):
-        """Get explicit names for some destinations."""
-        if dest == "PARIS (intramuros)":
-            return "PARIS"
-        if dest == "CORBIERES VIERZON VILLE":
-            return "VIERZON"
-        if dest == "VALENCE TGV RHONE ALPES SUD":
-            return "VALENCE FRANCE ALPES"
-        if dest == "MONTELIMAR GARE SNCF":
-            return "MONTELIMAR"
-        if dest == "CORBIERES LES AUBRAIS ORLEANS":
-            return "ORLEANS"
-        if dest == "LYON (gares intramuros)":
-            return "LYON"
-        if dest == "AEROPORT CDG2 TGV ROISSY":
-            return "ROISSY AEROPORT"
-        if dest == "ST DENIS PRES MARTEL":
-            return "MARTEL"
-        if dest == "DIE":
-            return "GARE DIE"
-        if dest == "JUVISY TGV":
-            return "GARE JUVISY"
-        if dest == "ORANGE":
-            return "ORANGE FRANCE"
-        if dest == "SABLE":
-            return "SABLE SUR SARTHE"
-        return dest
-
-    def get_dest_list(csv_src):
-        """Get destinations list."""
-        df_src = pd.read_csv(csv_src, sep=';')
-        return GeolocUpdater.get_unique_destinations(df_src)
-
-    def get_unique_destinations(df_src):
-        """Get the list of unique destinations (without duplicatas)."""
-        destinations = []
-        for dest in df_src["Destination"]:
-            found = False
-            for already_dest in destinations:
-                if dest == already_dest:
-                    found = True
-                    break
-            if not found:
-                destinations.append(dest)
-        destinations.sort(key=lambda x: x[0][0])
-        return destinations
-
-    def generate(self):
-        """Get GPS coordinates for each city."""
-        destinations = GeolocUpdater.get_dest_list(self.csv_src)
-
-        dataframe = pd.DataFrame(data={"CITY": destinations})
-        dataframe["LAT"] = 0.0000
-        dataframe["LON"] = 0.0000
-        row = 0
-
-        for city in destinations:
-            if os.path.isfile(self.csv_geoloc_temp):
-                df_already_written = pd.read_csv(self.csv_geoloc_temp)
-                if df_already_written["LAT"][row] != 0.0000:
-                    dataframe["LAT"][row] = \
-                        df_already_written["LAT"][row]
-                    dataframe["LON"][row] = \
-                        df_already_written["LON"][row]
-                    row += 1
-                    continue
-            city = GeolocUpdater.get_explicit_name(city)
-            time.sleep(0.1)
-            geolocator = Nominatim()
-            loc = geolocator.geocode(city)
-            if loc is None:
+    def get_station_list(snapshot_path):
+        """Get sorted stations list, as origin or destination."""
+        snapshot = SnapshotReader(snapshot_path)
+        codes = np.union1d(snapshot.column(COL_ORIGIN), \
+            snapshot.column(COL_DEST))
+        return list(snapshot.decode_cities(codes))
+
+    def read_coords(csv_coords):
+        """Read already known cities coordinates, empty if none."""
+        if not os.path.isfile(csv_coords):
+            return pd.DataFrame(columns=["CITY", "LAT", "LON"])
+        return pd.read_csv(csv_coords, index_col=0)
+
+    def generate(self, snapshot_path=None):
+        """Get GPS coordinates for stations missing from the CSV file."""
+        df_known = GeolocUpdater.read_coords(self.csv_dest)
+        stations = GeolocUpdater.get_station_list(snapshot_path or \
+            self.csv_src)
+        new_stations = sorted(set(stations) - set(df_known["CITY"]))
+        if not new_stations:
+            print("All stations coordinates are already known")
+            return
+
+        if self.geocoder is None:
+            self.geocoder = default_geocoder()
+        engine = GeocodeEngine(self.geocoder, \
+            GeocodeCache(self.csv_geocode_cache))
+        coords = engine.geocode_all(new_stations)
+        # Geocoders given by callers may only have a geocode method
+        for line in getattr(self.geocoder, "report", list)():
+            print(line)
+
+        found = []
+        for city in new_stations:
+            if coords[city] is None:
                 print("ERROR : cannot find location for " + city)
             else:
-                dataframe["LAT"][row] = loc.latitude
-                dataframe["LON"][row] = loc.longitude
-            row += 1
-            print(str(round(row/len(destinations)*100, 2))+" %")
-
-            dataframe.to_csv(self.csv_geoloc_temp)
-        os.remove(self.csv_geoloc_temp)
-        dataframe.to_csv(self.csv_dest)
+                found.append((city,) + coords[city])
+        df_new = pd.DataFrame(data=found, columns=["CITY", "LAT", "LON"])
+        dataframe = pd.concat([df_known, df_new], ignore_index=True) \
+            .sort_values(by="CITY").reset_index(drop=True)
+        # Datasets may be loading the coordinates meanwhile
+        dataframe.to_csv(self.csv_dest + ".tmp")
+        os.replace(self.csv_dest + ".tmp", self.csv_dest)
+        print(str(len(df_new)) + " new stations coordinates added")
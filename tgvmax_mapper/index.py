@@ -0,0 +1,105 @@
+"""Sorted journeys index for city, date and departure time range lookups."""
+
+import json
+import os
+
+import numpy as np
+
+from snapshot import COL_ORIGIN, COL_DEST, COL_DATE, COL_DEPART
+
+OUTBOUND = "out"
+RETURN = "ret"
+DIRECTIONS = {OUTBOUND : COL_ORIGIN, RETURN : COL_DEST}
+INDEX_FILE = "index.json"
+
+PERM = "perm"
+MINUTES = "minutes"
+OFFSETS = "offsets"
+
+
+def index_filepath(snapshot_path, direction, name):
+    """Get the filepath of one index array."""
+    return os.path.join(snapshot_path, "index_" + direction + "_" + name + ".npy")
+
+
+class JourneyIndex:
+    """Journeys sorted by (city, date, departure minute) with offset tables.
+
+    One sort is kept by origin for outbound lookups and one by destination
+    for return lookups. Offsets delimit each (city, date) bucket so a query
+    is two binary searches on the bucket minutes plus a slice.
+    """
+
+    def __init__(self, snapshot):
+        """Load the index of a snapshot, building it if missing."""
+        self.snapshot = snapshot
+        filepath = os.path.join(snapshot.snapshot_path, INDEX_FILE)
+        if not os.path.isfile(filepath):
+            JourneyIndex.build(snapshot)
+        with open(filepath) as infile:
+            meta = json.load(infile)
+        self.first_date = meta["first_date"]
+        self.nb_days = meta["nb_days"]
+        mmap_mode = 'r' if len(snapshot) else None
+        self.arrays = {}
+        for direction in DIRECTIONS:
+            self.arrays[direction] = {name : np.load( \
+                index_filepath(snapshot.snapshot_path, direction, name), \
+                mmap_mode=mmap_mode) for name in [PERM, MINUTES, OFFSETS]}
+
+    def build(snapshot):
+        """Sort snapshot journeys and write the index arrays."""
+        cols = snapshot.read_columns([COL_ORIGIN, COL_DEST, COL_DATE, \
+            COL_DEPART])
+        dates = cols[COL_DATE]
+        first_date = int(dates.min()) if len(dates) else 0
+        nb_days = int(dates.max()) - first_date + 1 if len(dates) else 0
+        nb_buckets = len(snapshot.cities) * nb_days
+
+        for direction, column in DIRECTIONS.items():
+            perm = np.lexsort((cols[COL_DEPART], dates, cols[column]))
+            buckets = cols[column][perm].astype(np.int64) * nb_days + \
+                (dates[perm] - first_date)
+            offsets = np.zeros(nb_buckets + 1, dtype=np.int64)
+            np.cumsum(np.bincount(buckets, minlength=nb_buckets), \
+                out=offsets[1:])
+            arrays = {
+                PERM : perm.astype(np.int32),
+                MINUTES : np.ascontiguousarray(cols[COL_DEPART][perm]),
+                OFFSETS : offsets
+            }
+            for name, values in arrays.items():
+                np.save(index_filepath(snapshot.snapshot_path, direction, \
+                    name), values)
+
+        with open(os.path.join(snapshot.snapshot_path, INDEX_FILE), 'w') \
+                as outfile:
+            json.dump({"first_date" : first_date, "nb_days" : nb_days}, outfile)
+
+    def bucket_bounds(self, direction, city_code, date):
+        """Get the index slice bounds of one (city, date) bucket."""
+        day = date - self.first_date
+        if not 0 <= day < self.nb_days:
+            return 0, 0
+        offsets = self.arrays[direction][OFFSETS]
+        bucket = city_code * self.nb_days + day
+        return int(offsets[bucket]), int(offsets[bucket + 1])
+
+    def lookup(self, direction, city_code, date, min_minute, max_minute):
+        """Get rows of one city and date departing in [min, max) minutes."""
+        start, end = self.bucket_bounds(direction, city_code, date)
+        minutes = self.arrays[direction][MINUTES][start:end]
+        low = start + np.searchsorted(minutes, min_minute, side='left')
+        high = start + np.searchsorted(minutes, max_minute, side='left')
+        return self.arrays[direction][PERM][low:high]
+
+    def lookup_dates(self, direction, city_code, min_minute, max_minute):
+        """Get rows of one city over every date departing in [min, max)."""
+        offsets = self.arrays[direction][OFFSETS]
+        if not self.nb_days:
+            return self.arrays[direction][PERM][:0]
+        start = int(offsets[city_code * self.nb_days])
+        end = int(offsets[(city_code + 1) * self.nb_days])
+        minutes = self.arrays[direction][MINUTES][start:end]
+        return self.arrays[direction][PERM][start:end][ \
+            (minutes >= min_minute) & (minutes < max_minute)]
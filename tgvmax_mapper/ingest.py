@@ -0,0 +1,156 @@
+"""Stream the SNCF open data export straight into a snapshot."""
+
+import array
+import codecs
+import csv
+
+import numpy as np
+
+from snapshot import SnapshotWriter, COLUMNS_DTYPES, date_to_ordinal
+from snapshot import train_to_number
+from snapshot import COL_ORIGIN, COL_DEST, COL_DATE, COL_DEPART, COL_DISPO
+from snapshot import COL_TRAIN, COL_ARRIVAL
+from snapshot import DATE, TRAIN_NO, ORIGINE, DESTINATION, DEPART_TIME
+from snapshot import ARRIVAL_TIME
+from snapshot import DISPO_MAX
+
+DISPO_TGVMAX = "Disponibilité de places TGV Max"
+CSV_SEPARATOR = ";"
+CHUNK_SIZE = 1024*1024
+ENCODING = "utf-8-sig"
+HTTP_NOT_MODIFIED = 304
+
+# array.array typecodes of the snapshot columns while ingesting
+TYPECODES = {
+    COL_ORIGIN : 'h',
+    COL_DEST : 'h',
+    COL_DATE : 'i',
+    COL_DEPART : 'h',
+    COL_ARRIVAL : 'h',
+    COL_DISPO : 'b',
+    COL_TRAIN : 'i'
+}
+
+
+class StreamIngester:
+    """Parse CSV rows as bytes arrive and keep only useful typed columns.
+
+    Unavailable journeys and unused columns are dropped on the fly, so
+    memory is bounded by the kept typed columns, not by the raw export.
+    """
+
+    def __init__(self, url, chunk_size=CHUNK_SIZE, progress_cb=None):
+        """Init ingester with the export URL and a progress callback.
+
+        progress_cb is called with bytes seen and total bytes (None when
+        the server sends no Content-Length).
+        """
+        self.url = url
+        self.chunk_size = chunk_size
+        self.progress_cb = progress_cb
+        self.bytes_seen = 0
+        self.bytes_total = None
+        self.etag = None
+        self.last_modified = None
+        self.city_codes = {}
+        self.dates = {}
+        self.times = {}
+        self.columns = {name : array.array(typecode) \
+            for name, typecode in TYPECODES.items()}
+
+    def iter_lines(self, response):
+        """Decode response chunks into text lines, reporting progress."""
+        decoder = codecs.getincrementaldecoder(ENCODING)()
+        pending = ""
+        for chunk in response.iter_content(chunk_size=self.chunk_size):
+            if not chunk:  # filter out keep-alive new chunks
+                continue
+            self.bytes_seen += len(chunk)
+            if self.progress_cb is not None:
+                self.progress_cb(self.bytes_seen, self.bytes_total)
+            lines = (pending + decoder.decode(chunk)).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        pending += decoder.decode(b"", final=True)
+        if pending:
+            yield pending
+
+    def encode_city(self, city):
+        """Get a city code, in order of first appearance."""
+        code = self.city_codes.get(city)
+        if code is None:
+            code = len(self.city_codes)
+            self.city_codes[city] = code
+        return code
+
+    def encode_date(self, date):
+        """Get a date ordinal, cached since few dates are distinct."""
+        ordinal = self.dates.get(date)
+        if ordinal is None:
+            ordinal = date_to_ordinal(date)
+            self.dates[date] = ordinal
+        return ordinal
+
+    def encode_time(self, hour):
+        """Get minutes since midnight, cached since few times are distinct."""
+        minutes = self.times.get(hour)
+        if minutes is None:
+            hours, mins = hour.split(":")[:2]
+            minutes = int(hours) * 60 + int(mins)
+            self.times[hour] = minutes
+        return minutes
+
+    def ingest(self, lines):
+        """Filter and encode CSV lines into the typed column buffers."""
+        reader = csv.reader(lines, delimiter=CSV_SEPARATOR)
+        header = next(reader, None)
+        if header is None:
+            return
+        fields = [DISPO_TGVMAX, ORIGINE, DESTINATION, DATE, DEPART_TIME, \
+            ARRIVAL_TIME, DISPO_MAX, TRAIN_NO]
+        i_tgvmax, i_origin, i_dest, i_date, i_depart, i_arrival, i_dispo, \
+            i_train = [header.index(field) for field in fields]
+        cols = self.columns
+        for row in reader:
+            if len(row) < len(header) or row[i_tgvmax] != "OUI":
+                continue
+            cols[COL_ORIGIN].append(self.encode_city(row[i_origin]))
+            cols[COL_DEST].append(self.encode_city(row[i_dest]))
+            cols[COL_DATE].append(self.encode_date(row[i_date]))
+            cols[COL_DEPART].append(self.encode_time(row[i_depart]))
+            cols[COL_ARRIVAL].append(self.encode_time(row[i_arrival]))
+            cols[COL_DISPO].append(row[i_dispo] == "OUI")
+            cols[COL_TRAIN].append(train_to_number(row[i_train]))
+
+    def finalize(self):
+        """Get sorted cities and typed columns with codes in that order."""
+        cities = sorted(self.city_codes)
+        remap = np.empty(len(cities), dtype=np.int16)
+        for code, city in enumerate(cities):
+            remap[self.city_codes[city]] = code
+        columns = {name : np.frombuffer(values, dtype=values.typecode) \
+            .astype(COLUMNS_DTYPES[name]) for name, values in self.columns.items()}
+        for name in [COL_ORIGIN, COL_DEST]:
+            columns[name] = remap[columns[name]]
+        return cities, columns
+
+    def run(self, snapshot_path, headers=None):
+        """Download, filter and write the snapshot, return its rows number.
+
+        headers may hold HTTP validators, None is returned when the server
+        answers the export is not modified.
+        """
+        import requests
+        response = requests.get(self.url, stream=True, headers=headers)
+        if response.status_code == HTTP_NOT_MODIFIED:
+            return None
+        response.raise_for_status()
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        if response.headers.get("Content-Length"):
+            self.bytes_total = int(response.headers["Content-Length"])
+        self.ingest(self.iter_lines(response))
+        cities, columns = self.finalize()
+        SnapshotWriter(snapshot_path).write_columns(cities, columns)
+        return len(columns[COL_DATE])
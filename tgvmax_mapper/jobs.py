@@ -0,0 +1,84 @@
+"""Run searches in a worker pool, off the UI event loop."""
+
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+
+SEARCH_WORKERS = 1
+
+
+class SearchCancelled(Exception):
+    """Raised by a progress callback to stop a search between stages."""
+
+class SearchJob:
+    """One search submitted to the worker pool, cancellable between stages."""
+
+    def __init__(self, map_creator, user_entries):
+        """Init the job with its own map creator and user entries."""
+        self.map_creator = map_creator
+        self.user_entries = user_entries
+        self.cancel_event = threading.Event()
+        self.stages = queue.Queue()
+        self.future = None
+
+    def report(self, stage):
+        """Queue the stage about to run, stop here if cancelled."""
+        if self.cancel_event.is_set():
+            raise SearchCancelled(stage)
+        self.stages.put(stage)
+
+    def run(self):
+        """Run the search, its results frame is handed back in memory."""
+        return self.map_creator.generate(self.user_entries, self.report)
+
+    def cancel(self):
+        """Cancel the job, before it starts or at its next stage."""
+        self.cancel_event.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def pop_stages(self):
+        """Get stages reported since last call."""
+        stages = []
+        while True:
+            try:
+                stages.append(self.stages.get_nowait())
+            except queue.Empty:
+                return stages
+
+    def is_cancelled(self):
+        """Check if the job stopped because it was cancelled."""
+        if self.future.cancelled():
+            return True
+        return isinstance(self.future.exception(), SearchCancelled)
+
+
+class SearchRunner:
+    """Submit searches to a worker pool, a new search superseding older ones."""
+
+    def __init__(self, max_workers=SEARCH_WORKERS):
+        """Init the worker pool."""
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.current = None
+
+    def submit(self, map_creator, user_entries):
+        """Cancel the running search and submit a new one."""
+        self.cancel()
+        job = SearchJob(map_creator, user_entries)
+        job.future = self.executor.submit(job.run)
+        self.current = job
+        return job
+
+    def preload(self, task):
+        """Run a task ahead of any search, as loading data, get its future."""
+        return self.executor.submit(task)
+
+    def cancel(self):
+        """Cancel the latest search if any."""
+        if self.current is not None:
+            self.current.cancel()
+
+    def shutdown(self):
+        """Cancel searches and stop the workers."""
+        self.cancel()
+        self.executor.shutdown(wait=False)
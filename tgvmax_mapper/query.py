@@ -0,0 +1,366 @@
+"""Headless TGVmax destinations queries, without any GUI dependency."""
+
+import argparse
+import csv
+import datetime
+import json
+import sys
+
+from connections import MIN_TRANSFER_MIN
+from data_validity import TimeKeeper
+from dataset import Dataset
+from geoloc import GeolocUpdater, CSV_GEOCODE_CACHE
+from refresh import DataRefresher
+from search import MapCreator, make_user_entries, RETURN_DATE_ORD, RETURN_MIN
+from settings import SNAPSHOT_DIR, CSV_COORDS, UPDT_TMS_PATH, HTML_FILEPATH
+from settings import FLEX_HTML_FILEPATH, SUBSCRIPTIONS_PATH
+from settings import OPENDATA_URL, CHUNK_SIZE, UPDT_DELAY_S
+from settings import SERVER_HOST, SERVER_PORT, SERVER_WORKERS
+from snapshot import DATE_ORD, DEPART_MIN, ORIGIN_CODE, DEST_CODE
+from snapshot import ARRIVAL_MIN
+from store import SnapshotStore
+from subscriptions import SubscriptionStore, SubscriptionWatcher
+
+FORMATS = ["json", "csv", "html", "payload", "destinations"]
+FLEX_FORMATS = ["json", "csv", "html", "table"]
+BATCH_FORMATS = ["html", "payload", "json", "csv"]
+INTERNAL_COLUMNS = [DATE_ORD, DEPART_MIN, ARRIVAL_MIN, ORIGIN_CODE, \
+    DEST_CODE, RETURN_DATE_ORD, RETURN_MIN]
+
+
+def load_dataset(snapshot_dir=SNAPSHOT_DIR, csv_coords=CSV_COORDS):
+    """Load the published snapshot, None if no data was downloaded yet."""
+    store = SnapshotStore(snapshot_dir)
+    if store.current_path() is None:
+        return None
+    return Dataset.load_current(store, csv_coords)
+
+def run_query(dataset, user_entries, cache=None):
+    """Get journeys matching user entries as a dataframe."""
+    return MapCreator(None, dataset, cache=cache).search(user_entries)
+
+def public_columns(dataframe):
+    """Drop internal typed columns before exporting results."""
+    return dataframe.drop(columns=[col for col in INTERNAL_COLUMNS \
+        if col in dataframe])
+
+def write_results(dataset, user_entries, dataframe, out_format, output):
+    """Write results as JSON, CSV, an HTML map or a map shell payload."""
+    if out_format == "html":
+        MapCreator(output or HTML_FILEPATH, dataset).display(dataframe, \
+            user_entries["origin_city"], user_entries["mode"], \
+            user_entries["isochrone"])
+        return
+    if out_format == "payload":
+        text = json.dumps(MapCreator(None, dataset).payload(dataframe, \
+            user_entries), ensure_ascii=False, separators=(",", ":"))
+    elif out_format == "json":
+        text = public_columns(dataframe).to_json(orient="records", \
+            force_ascii=False)
+    else:
+        text = public_columns(dataframe).to_csv(index=False)
+    if output is None:
+        sys.stdout.write(text + "\n")
+        return
+    with open(output, 'w') as outfile:
+        outfile.write(text)
+
+def parse_date(date_str):
+    """Parse a YYYY-MM-DD command line date."""
+    try:
+        return datetime.date.fromisoformat(date_str)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date " + date_str)
+
+def parse_stay(stay_str):
+    """Parse a command line stay, in whole days."""
+    if not stay_str.isdigit() or int(stay_str) < 1:
+        raise argparse.ArgumentTypeError("invalid stay " + stay_str + \
+            ", at least one day")
+    return int(stay_str)
+
+def add_query_arguments(parser):
+    """Add search arguments to a command line parser."""
+    parser.add_argument("--from", dest="origin", required=True, \
+        help="departure city, as named into SNCF data")
+    parser.add_argument("--date", type=parse_date, required=True, \
+        help="departure date, YYYY-MM-DD")
+    parser.add_argument("--minh", default="3", \
+        help="minimum departure hour or HH:MM")
+    parser.add_argument("--maxh", default="23", \
+        help="maximum departure hour or HH:MM, excluded")
+    parser.add_argument("--return", dest="return_date", type=parse_date, \
+        help="return date, YYYY-MM-DD, for round-trips")
+    parser.add_argument("--return-minh", default="3")
+    parser.add_argument("--return-maxh", default="23")
+    parser.add_argument("--min-stay", type=float, help="in hours")
+    parser.add_argument("--max-stay", type=float, help="in hours")
+    parser.add_argument("--to", dest="destination", \
+        help="only journeys to this destination")
+    parser.add_argument("--max-duration", type=float, \
+        help="maximum outbound trip duration, in hours")
+    parser.add_argument("--isochrone", action="store_true", \
+        help="color destinations by shortest trip on HTML maps")
+    parser.add_argument("--max-transfers", type=int, default=0, \
+        help="connections allowed for one-way searches")
+    parser.add_argument("--min-transfer", type=int, \
+        default=MIN_TRANSFER_MIN, help="minimum connection time, in minutes")
+
+def query_entries(args):
+    """Get user entries from parsed command line arguments."""
+    return make_user_entries(args.origin, args.date, args.minh, args.maxh, \
+        args.return_date, args.return_minh, args.return_maxh, \
+        args.min_stay, args.max_stay, args.max_transfers, args.min_transfer, \
+        args.max_duration, args.isochrone, args.destination)
+
+def query_cmd(args):
+    """Run one query and write its results."""
+    dataset = load_dataset()
+    if dataset is None:
+        print("ERROR : no local data, run the refresh command first", \
+            file=sys.stderr)
+        return 1
+    user_entries = query_entries(args)
+    if args.format == "destinations":
+        text = json.dumps(MapCreator(None, dataset).reachable(user_entries), \
+            ensure_ascii=False)
+        if args.output is None:
+            sys.stdout.write(text + "\n")
+            return 0
+        with open(args.output, 'w') as outfile:
+            outfile.write(text)
+        return 0
+    dataframe = run_query(dataset, user_entries)
+    write_results(dataset, user_entries, dataframe, args.format, args.output)
+    return 0
+
+def data_refresher(store, time_keeper):
+    """Get a refresher geocoding new stations and checking saved searches."""
+    watcher = SubscriptionWatcher(store, CSV_COORDS, SUBSCRIPTIONS_PATH)
+    return DataRefresher(OPENDATA_URL, store, time_keeper, CHUNK_SIZE, \
+        watcher.check, GeolocUpdater(None, CSV_GEOCODE_CACHE, CSV_COORDS))
+
+def refresh_cmd(args):
+    """Refresh local data if outdated, or always when forced."""
+    time_keeper = TimeKeeper(UPDT_TMS_PATH, UPDT_DELAY_S)
+    store = SnapshotStore(SNAPSHOT_DIR)
+    if not args.force and store.current_path() is not None and \
+            not time_keeper.is_tms_outdated():
+        print("Local data is up to date")
+        return 0
+    data_refresher(store, time_keeper).refresh()
+    return 0
+
+def serve_cmd(args):
+    """Serve queries over local HTTP until interrupted."""
+    from refresh import BackgroundRefresher
+    from server import serve
+    store = SnapshotStore(SNAPSHOT_DIR)
+    if store.current_path() is None:
+        print("ERROR : no local data, run the refresh command first", \
+            file=sys.stderr)
+        return 1
+    refresher = None
+    if not args.no_refresh:
+        refresher = BackgroundRefresher(data_refresher(store, \
+            TimeKeeper(UPDT_TMS_PATH, UPDT_DELAY_S)))
+    serve(store, CSV_COORDS, args.host, args.port, args.workers, refresher, \
+        args.cache_dir)
+    return 0
+
+def flex_cmd(args):
+    """Run one flexible dates search and write its date matrix."""
+    from flexible import FlexibleSearch, make_flex_entries
+    dataset = load_dataset()
+    if dataset is None:
+        print("ERROR : no local data, run the refresh command first", \
+            file=sys.stderr)
+        return 1
+    flex_search = FlexibleSearch(dataset, args.output or FLEX_HTML_FILEPATH)
+    user_entries = make_flex_entries(args.origin, args.minh, args.maxh, \
+        args.stay, args.return_minh, args.return_maxh)
+    matrix = flex_search.compute(user_entries)
+    if args.format == "html":
+        flex_search.render(matrix, args.origin).save(flex_search.html_filepath)
+        return 0
+    if args.format == "table":
+        text = flex_search.table_html(matrix)
+    elif args.format == "json":
+        text = flex_search.frame(matrix).to_json(orient="records", \
+            force_ascii=False)
+    else:
+        text = flex_search.frame(matrix).to_csv(index=False)
+    if args.output is None:
+        sys.stdout.write(text + "\n")
+        return 0
+    with open(args.output, 'w') as outfile:
+        outfile.write(text)
+    return 0
+
+def parse_dates(dates_str):
+    """Parse a YYYY-MM-DD date or a YYYY-MM-DD:YYYY-MM-DD range, included."""
+    first, _, last = dates_str.partition(":")
+    first = parse_date(first)
+    last = parse_date(last) if last else first
+    return [first + datetime.timedelta(days=day) \
+        for day in range((last - first).days + 1)]
+
+def parse_window(window_str):
+    """Parse a MINH-MAXH hours window."""
+    minh, sep, maxh = window_str.partition("-")
+    if not sep or not minh.isdigit() or not maxh.isdigit():
+        raise argparse.ArgumentTypeError("invalid window " + window_str)
+    return int(minh), int(maxh)
+
+def batch_cmd(args):
+    """Run the product of origins, dates, windows and modes in parallel."""
+    from batch import BatchRunner, REPORT_HEADER, make_jobs, report_row, \
+        summary
+    store = SnapshotStore(SNAPSHOT_DIR)
+    manifest = store.read_manifest()
+    if store.current_path() is None or manifest is None:
+        print("ERROR : no local data, run the refresh command first", \
+            file=sys.stderr)
+        return 1
+    origins = manifest["stations"] if args.all_origins else args.origins
+    if args.all_dates and manifest["first_date"] is None:
+        print("ERROR : no journeys in local data, cannot expand --all-dates", \
+            file=sys.stderr)
+        return 1
+    if args.all_dates:
+        dates = parse_dates(manifest["first_date"] + ":" + \
+            manifest["last_date"])
+    else:
+        dates = [date for dates in args.dates for date in dates]
+    stays = args.stays or []
+    if args.oneway or not stays:
+        stays = [None] + stays
+    if not origins or not dates:
+        print("ERROR : origins and dates are required", file=sys.stderr)
+        return 1
+
+    jobs = make_jobs(origins, dates, args.windows or [(3, 23)], stays)
+    runner = BatchRunner(store, CSV_COORDS, args.workers)
+    report = open(args.report, 'w', newline='') if args.report else sys.stdout
+    try:
+        writer = csv.writer(report, lineterminator="\n")
+        writer.writerow(REPORT_HEADER)
+        results, elapsed_s = runner.run(jobs, args.out_dir, args.format, \
+            lambda result: writer.writerow(report_row(result)))
+    finally:
+        if args.report:
+            report.close()
+    print(summary(results, elapsed_s, runner.workers))
+    return 0 if all(result.error is None for result in results) else 1
+
+def subscribe_cmd(args):
+    """Save a search, list, remove or check saved searches."""
+    subscriptions = SubscriptionStore(SUBSCRIPTIONS_PATH)
+    if args.action == "add":
+        print(subscriptions.add(args.name, query_entries(args)))
+    elif args.action == "list":
+        for sub_id, (name, user_entries) in \
+                subscriptions.subscriptions().items():
+            print(sub_id + "\t" + name + "\t" + user_entries["origin_city"] + \
+                "\t" + user_entries["departure"]["date"].isoformat())
+    elif args.action == "remove":
+        if not subscriptions.remove(args.id):
+            print("ERROR : unknown saved search " + args.id, file=sys.stderr)
+            return 1
+    else:
+        store = SnapshotStore(SNAPSHOT_DIR)
+        if store.current_path() is None:
+            print("ERROR : no local data, run the refresh command first", \
+                file=sys.stderr)
+            return 1
+        changes = SubscriptionWatcher(store, CSV_COORDS, \
+            SUBSCRIPTIONS_PATH).check()
+        print(str(len(changes)) + " saved searches changed")
+    return 0
+
+def build_parser():
+    """Build the command line parser of headless commands."""
+    parser = argparse.ArgumentParser(prog="tgvmax_mapper")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    query = commands.add_parser("query", help="search TGVmax destinations")
+    add_query_arguments(query)
+    query.add_argument("--format", choices=FORMATS, default="json")
+    query.add_argument("--output", help="output file, stdout by default")
+    query.set_defaults(func=query_cmd)
+
+    flex = commands.add_parser("flex", \
+        help="count TGVmax trains of every date of the booking window")
+    flex.add_argument("--from", dest="origin", required=True, \
+        help="departure city, as named into SNCF data")
+    flex.add_argument("--minh", default="3", \
+        help="minimum departure hour or HH:MM")
+    flex.add_argument("--maxh", default="23", \
+        help="maximum departure hour or HH:MM, excluded")
+    flex.add_argument("--stay", type=parse_stay, \
+        help="days between departure and return, for round-trips")
+    flex.add_argument("--return-minh", default="3")
+    flex.add_argument("--return-maxh", default="23")
+    flex.add_argument("--format", choices=FLEX_FORMATS, default="json")
+    flex.add_argument("--output", help="output file, stdout by default")
+    flex.set_defaults(func=flex_cmd)
+
+    batch = commands.add_parser("batch", \
+        help="write results of many searches, across worker processes")
+    batch.add_argument("--from", dest="origins", action="append", \
+        default=[], help="departure city, repeatable")
+    batch.add_argument("--all-origins", action="store_true")
+    batch.add_argument("--date", dest="dates", type=parse_dates, \
+        action="append", default=[], \
+        help="YYYY-MM-DD or YYYY-MM-DD:YYYY-MM-DD, repeatable")
+    batch.add_argument("--all-dates", action="store_true", \
+        help="every date of the booking window")
+    batch.add_argument("--window", dest="windows", type=parse_window, \
+        action="append", help="departure hours as MINH-MAXH, repeatable")
+    batch.add_argument("--stay", dest="stays", type=parse_stay, \
+        action="append", help="round trips of this many days, repeatable")
+    batch.add_argument("--oneway", action="store_true", \
+        help="one-way searches too, the default without --stay")
+    batch.add_argument("--format", choices=BATCH_FORMATS, \
+        default="html")
+    batch.add_argument("--out-dir", required=True, \
+        help="one file per search is written under this directory")
+    batch.add_argument("--workers", type=int, \
+        help="worker processes, one per CPU by default")
+    batch.add_argument("--report", help="per search timings CSV, stdout " + \
+        "by default")
+    batch.set_defaults(func=batch_cmd)
+
+    subscribe = commands.add_parser("subscribe", \
+        help="saved searches, checked on each data refresh")
+    actions = subscribe.add_subparsers(dest="action", required=True)
+    add = actions.add_parser("add", help="save a search")
+    add.add_argument("--name", required=True)
+    add_query_arguments(add)
+    actions.add_parser("list", help="list saved searches")
+    remove = actions.add_parser("remove", help="delete a saved search")
+    remove.add_argument("id")
+    actions.add_parser("check", \
+        help="report saved searches changed since last check")
+    subscribe.set_defaults(func=subscribe_cmd)
+
+    refresh = commands.add_parser("refresh", help="refresh SNCF data")
+    refresh.add_argument("--force", action="store_true")
+    refresh.set_defaults(func=refresh_cmd)
+
+    serve = commands.add_parser("serve", help="serve queries over local HTTP")
+    serve.add_argument("--host", default=SERVER_HOST)
+    serve.add_argument("--port", type=int, default=SERVER_PORT)
+    serve.add_argument("--workers", type=int, default=SERVER_WORKERS, \
+        help="searches run in parallel")
+    serve.add_argument("--no-refresh", action="store_true", \
+        help="serve local data as is, without refreshing it")
+    serve.add_argument("--cache-dir", \
+        help="spill cached results evicted from memory to this directory")
+    serve.set_defaults(func=serve_cmd)
+    return parser
+
+def main(argv):
+    """Run a headless command, return the exit code."""
+    args = build_parser().parse_args(argv)
+    return args.func(args)
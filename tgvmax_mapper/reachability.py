@@ -0,0 +1,98 @@
+"""Daily origin x destination reachability bitsets by departure hour."""
+
+import json
+import os
+
+import numpy as np
+
+from snapshot import COL_ORIGIN, COL_DEST, COL_DATE, COL_DEPART, COL_DISPO
+
+REACH_FILE = "reachability.npy"
+REACH_META_FILE = "reachability.json"
+HOURS_PER_DAY = 24
+BIT_ORDER = "little"
+
+
+class ReachabilityIndex:
+    """Available trains as one packed bitset of destinations per origin.
+
+    Bits are indexed by (date, departure hour, origin) and packed over
+    destinations, so a search on whole hours ORs a few rows. Returns to an
+    origin are the bit of that origin in every row, as a transposed column.
+    """
+
+    def __init__(self, snapshot):
+        """Load the bitsets of a snapshot, building them if missing."""
+        self.snapshot = snapshot
+        filepath = os.path.join(snapshot.snapshot_path, REACH_META_FILE)
+        if not os.path.isfile(filepath):
+            ReachabilityIndex.build(snapshot)
+        with open(filepath) as infile:
+            meta = json.load(infile)
+        self.first_date = meta["first_date"]
+        self.nb_days = meta["nb_days"]
+        self.bits = np.load(os.path.join(snapshot.snapshot_path, REACH_FILE), \
+            mmap_mode='r' if self.nb_days else None)
+
+    def build(snapshot):
+        """Pack available trains of a snapshot into bitsets and write them."""
+        cols = snapshot.read_columns([COL_ORIGIN, COL_DEST, COL_DATE, \
+            COL_DEPART, COL_DISPO])
+        rows = np.flatnonzero(cols[COL_DISPO])
+        dates = cols[COL_DATE][rows]
+        first_date = int(dates.min()) if len(dates) else 0
+        nb_days = int(dates.max()) - first_date + 1 if len(dates) else 0
+        nb_cities = len(snapshot.cities)
+
+        bits = np.zeros((nb_days, HOURS_PER_DAY, nb_cities, \
+            -(-nb_cities // 8)), dtype=np.uint8)
+        days = dates - first_date
+        hours = cols[COL_DEPART][rows] // 60
+        origins = cols[COL_ORIGIN][rows]
+        dests = cols[COL_DEST][rows]
+        # One day at a time, unpacked matrices of all days would be large
+        for day in range(nb_days):
+            on_day = days == day
+            matrix = np.zeros((HOURS_PER_DAY, nb_cities, nb_cities), \
+                dtype=np.bool_)
+            matrix[hours[on_day], origins[on_day], dests[on_day]] = True
+            bits[day] = np.packbits(matrix, axis=-1, bitorder=BIT_ORDER)
+
+        np.save(os.path.join(snapshot.snapshot_path, REACH_FILE), bits)
+        with open(os.path.join(snapshot.snapshot_path, REACH_META_FILE), \
+                'w') as outfile:
+            json.dump({"first_date" : first_date, "nb_days" : nb_days}, \
+                outfile)
+
+    def hours_rows(self, date, min_hour, max_hour):
+        """Get the bitset rows of one date departing in [min, max) hours."""
+        day = date - self.first_date
+        if not 0 <= day < self.nb_days:
+            return None
+        return self.bits[day, max(min_hour, 0):min(max_hour, HOURS_PER_DAY)]
+
+    def outbound(self, city_code, date, min_hour, max_hour):
+        """Get the packed bitset of cities reached from a city."""
+        rows = self.hours_rows(date, min_hour, max_hour)
+        if rows is None or not len(rows):
+            return np.zeros(self.bits.shape[-1], dtype=np.uint8)
+        return np.bitwise_or.reduce(rows[:, city_code], axis=0)
+
+    def inbound(self, city_code, date, min_hour, max_hour):
+        """Get the packed bitset of cities with a train to a city."""
+        rows = self.hours_rows(date, min_hour, max_hour)
+        if rows is None or not len(rows):
+            return np.zeros(self.bits.shape[-1], dtype=np.uint8)
+        column = np.bitwise_or.reduce(rows[:, :, city_code // 8], axis=0)
+        return np.packbits((column >> (city_code % 8)) & 1, \
+            bitorder=BIT_ORDER)
+
+    def destinations(self, city_code, date, min_hour, max_hour, \
+            return_date=None, return_min_hour=0, return_max_hour=24):
+        """Get codes of cities reachable from a city, and back if returning."""
+        reached = self.outbound(city_code, date, min_hour, max_hour)
+        if return_date is not None:
+            reached = reached & self.inbound(city_code, return_date, \
+                return_min_hour, return_max_hour)
+        return np.flatnonzero(np.unpackbits(reached, \
+            count=len(self.snapshot.cities), bitorder=BIT_ORDER))
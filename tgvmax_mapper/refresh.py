@@ -0,0 +1,149 @@
+"""Refresh local TGVmax data from SNCF open data."""
+
+import shutil
+import threading
+
+from diff import SnapshotDiff
+from index import JourneyIndex
+from ingest import StreamIngester, CHUNK_SIZE
+from reachability import ReachabilityIndex
+from snapshot import SnapshotReader
+
+CHECK_DELAY_S = 10*60
+
+
+class DataRefresher:
+    """Download the export only when modified and apply what changed."""
+
+    def __init__(self, url, store, time_keeper, chunk_size=CHUNK_SIZE, \
+            publish_cb=None, geoloc_updater=None):
+        """Init refresher with the export URL and the snapshot store.
+
+        publish_cb is called with each new version once published. With a
+        GeolocUpdater, stations of a new snapshot missing coordinates are
+        geocoded before it is published.
+        """
+        self.url = url
+        self.store = store
+        self.time_keeper = time_keeper
+        self.chunk_size = chunk_size
+        self.publish_cb = publish_cb
+        self.geoloc_updater = geoloc_updater
+        self.last_diff = None
+        self.last_versions = None
+
+    def refresh(self, progress_cb=None):
+        """Refresh the snapshot, return True if a new version was published.
+
+        The new snapshot is built into a temporary directory and swapped in
+        atomically, the directory is deleted if not published, on errors
+        too. The row-level diff against the previous snapshot is kept into
+        last_diff, None when nothing was downloaded or on first download.
+        """
+        self.last_versions = None
+        self.last_diff = None
+        previous_version, current_path = self.store.current()
+        new_path = self.store.new_temp_path()
+        try:
+            return self.build(previous_version, current_path, new_path, \
+                progress_cb)
+        finally:
+            shutil.rmtree(new_path, ignore_errors=True)
+
+    def build(self, previous_version, current_path, new_path, progress_cb):
+        """Download, index and publish a snapshot built into new_path."""
+        headers = {}
+        if current_path is not None:
+            headers = self.time_keeper.get_conditional_headers()
+        ingester = StreamIngester(self.url, self.chunk_size, progress_cb)
+        nb_rows = ingester.run(new_path, headers)
+        if nb_rows is None:
+            print("SNCF data not modified since last update")
+            self.time_keeper.write_cur_tms()
+            return False
+
+        if current_path is not None:
+            self.last_diff = SnapshotDiff(SnapshotReader(current_path), \
+                SnapshotReader(new_path))
+            if not len(self.last_diff):
+                print("SNCF data downloaded without any journey change")
+                self.write_update_infos(ingester)
+                return False
+
+        snapshot = SnapshotReader(new_path)
+        JourneyIndex.build(snapshot)
+        ReachabilityIndex.build(snapshot)
+        self.geolocate(new_path)
+        version = self.store.publish(new_path, snapshot.manifest())
+        print("SNCF data updated to version " + str(version))
+        if self.last_diff is not None:
+            self.last_versions = (previous_version, version)
+        self.write_update_infos(ingester)
+        self.published(version)
+        return True
+
+    def published(self, version):
+        """Call publish_cb, its errors never fail the refresh itself."""
+        if self.publish_cb is None:
+            return
+        try:
+            self.publish_cb(version)
+        except Exception as err: # pylint: disable=broad-except
+            print("ERROR : publish callback failed, " + repr(err))
+
+    def geolocate(self, snapshot_path):
+        """Geocode new stations of a snapshot, publishing it anyway on error."""
+        if self.geoloc_updater is None:
+            return
+        try:
+            self.geoloc_updater.generate(snapshot_path)
+        except Exception as err: # pylint: disable=broad-except
+            print("ERROR : geocoding new stations failed, " + repr(err))
+
+    def diff_between(self, old_version, new_version):
+        """Get the diff of the last published version, None if not that one."""
+        diff = self.last_diff
+        if self.last_versions != (old_version, new_version):
+            return None
+        return diff
+
+    def write_update_infos(self, ingester):
+        """Store update timestamp and HTTP validators of the download."""
+        self.time_keeper.write_validators(ingester.etag, ingester.last_modified)
+        self.time_keeper.write_cur_tms()
+
+
+class BackgroundRefresher(threading.Thread):
+    """Worker thread refreshing data whenever TimeKeeper reports it outdated.
+
+    Searches keep running on the published snapshot while a new one is
+    built, readers pick the new version up from the store once published.
+    """
+
+    def __init__(self, refresher, check_delay_s=CHECK_DELAY_S):
+        """Init the worker thread with the refresher to drive."""
+        super().__init__(daemon=True)
+        self.refresher = refresher
+        self.check_delay_s = check_delay_s
+        self.stop_event = threading.Event()
+        self.refreshing = False
+
+    def run(self):
+        """Check data validity periodically and refresh when outdated."""
+        import requests
+        while not self.stop_event.is_set():
+            if self.refresher.time_keeper.is_tms_outdated():
+                self.refreshing = True
+                try:
+                    self.refresher.refresh()
+                except (requests.RequestException, OSError, ValueError) as err:
+                    print("ERROR : data refresh failed, " + str(err))
+                except Exception as err: # pylint: disable=broad-except
+                    # Any error would otherwise end refreshing silently
+                    print("ERROR : data refresh failed, " + repr(err))
+                self.refreshing = False
+            self.stop_event.wait(self.check_delay_s)
+
+    def stop(self):
+        """Stop checking data validity."""
+        self.stop_event.set()
@@ -1,27 +1,118 @@
 """Create TGVmax destinations html map with given user infos."""
 
-import gc
-
-import folium
+import numpy as np
 import pandas as pd
 
+from connections import TRANSFERS, VIA, MIN_TRANSFER_MIN
+from index import OUTBOUND, RETURN
+from snapshot import date_to_ordinal, COL_DISPO, COL_ORIGIN, COL_DEST, \
+    DATE_ORD, DEPART_MIN, DEST_CODE, ARRIVAL_TIME, ARRIVAL_MIN
+
 DATE = "DATE"
 ORIGINE = "Origine"
 DESTINATION = "Destination"
 DEPART_TIME = "Heure_depart"
+RETURN_DATE = "DATE_retour"
+RETURN_TIME = "Heure_retour"
+RETURN_DATE_ORD = "DATE_retour_ordinal"
+RETURN_MIN = "Minute_retour"
+STAY = "Duree_sejour"
+DURATION = "Duree_trajet"
+COMMON_DEST = "CommonDest"
 LAT = "LAT"
 LON = "LON"
 
+INDEX_DIRECTIONS = {ORIGINE : OUTBOUND, DESTINATION : RETURN}
+INDEX_OTHER_CITY = {ORIGINE : COL_DEST, DESTINATION : COL_ORIGIN}
+
+# Search stages, reported before running
+STAGE_FILTER = "Recherche des trajets"
+STAGE_CONNECTIONS = "Recherche des correspondances"
+STAGE_DURATION = "Calcul des durées de trajet"
+STAGE_ROUNDTRIP = "Appariement des allers-retours"
+STAGE_SORT = "Tri des trajets"
+STAGE_GEOLOC = "Géolocalisation"
+STAGE_EXPORT = "Export des résultats"
+STAGE_DISPLAY = "Création de la carte"
+
 HTML_DEFAULT_ZOOM = 4
 HTML_TILES = "Stamen Terrain"
+HTML_LAYER = "Destinations"
+HTML_CONNECTIONS_LAYER = "Destinations avec correspondance"
+TRAVEL_INFOS = "Trajets"
+
+# Isochrone bands upper bounds in minutes, one more color for longer trips
+ISOCHRONE_BANDS_MIN = [60, 120, 180, 240, 300, 360]
+ISOCHRONE_COLORS = ["#1a9850", "#66bd63", "#a6d96a", "#fee08b", "#fdae61", \
+    "#f46d43", "#d73027"]
+
+# Map payload drawn by the static map shell, bumped on any layout change
+PAYLOAD_FORMAT = "tgvmax-destinations"
+PAYLOAD_FORMAT_VERSION = 3
+
+def make_user_entries(origin_city, date, minh, maxh, return_date=None, \
+        return_minh=3, return_maxh=23, min_stay=None, max_stay=None, \
+        max_transfers=0, min_transfer=MIN_TRANSFER_MIN, max_duration=None, \
+        isochrone=False, destination=None):
+    """Build search user entries, round-trip when a return date is given.
+
+    Dates are datetime.date objects, hours are whole hours or HH:MM times.
+    One-way searches also look for journeys with up to max_transfers
+    connections, of at least min_transfer minutes each. Outbound trips
+    last max_duration hours at most when given, isochrone maps color
+    destinations by their shortest trip. A destination restricts journeys
+    to that city only.
+    """
+    return {
+        "mode" : return_date is not None,
+        "origin_city" : origin_city,
+        "departure" : {"date" : date, "minh" : minh, "maxh" : maxh},
+        "return" : {"date" : return_date, "minh" : return_minh, \
+            "maxh" : return_maxh},
+        "min_stay" : min_stay,
+        "max_stay" : max_stay,
+        "max_transfers" : max_transfers,
+        "min_transfer" : min_transfer,
+        "max_duration" : max_duration,
+        "isochrone" : isochrone,
+        "destination" : destination
+    }
+
+
+def hour_to_minutes(hour):
+    """Convert a whole hour or a HH:MM time into minutes."""
+    if isinstance(hour, str) and ":" in hour:
+        hours, minutes = hour.split(":")
+        return int(hours) * 60 + int(minutes)
+    return int(hour) * 60
+
+def minutes_to_durations(minutes):
+    """Vectorized conversion of minutes into durations as 2h05."""
+    hours, mins = np.divmod(np.asarray(minutes, dtype=np.int64), 60)
+    return np.char.add(np.char.add(hours.astype(str), "h"), \
+        np.char.zfill(mins.astype(str), 2))
+
+def isochrone_bands(minutes):
+    """Get the isochrone band of each duration in minutes."""
+    return np.searchsorted(ISOCHRONE_BANDS_MIN, minutes, side='left')
+
+def isochrone_label(band):
+    """Get the legend label of an isochrone band."""
+    bounds = [0] + ISOCHRONE_BANDS_MIN
+    if band == len(ISOCHRONE_BANDS_MIN):
+        return "Plus de " + minutes_to_durations([bounds[band]])[0]
+    return minutes_to_durations([bounds[band]])[0] + " à " + \
+        minutes_to_durations([bounds[band + 1]])[0]
+
 
 class DataProcess:
     """Methods used for data processing."""
 
-    def __init__(self, csv_cut_path, csv_results_path):
-        """Init data process csv paths"""
-        self.csv_cut_path = csv_cut_path
-        self.csv_results_path = csv_results_path
+    def __init__(self, dataset):
+        """Init data process with the session dataset"""
+        self.dataset = dataset
+        self.snapshot = dataset.snapshot
+        self.index = dataset.index
 
     def convert_date(self, date_in):
         """Add missing zeroes for getting the correct date format."""
@@ -34,133 +125,227 @@ class DataProcess:
             str_day = "0" + str_day
         return str_year + "-" + str_month + "-" + str_day
 
-    def datetime_limit(self, datafrm, time_infos):
-        """Drop journeys out of the specified date and time."""
-        datafrm = datafrm[datafrm[DATE] == time_infos["date"]]
-        datafrm['int'] = int(time_infos["minh"])
-        datafrm = datafrm[list(map(int, \
-            datafrm[DEPART_TIME].str.slice(0, -3))) >= datafrm['int']]
-        datafrm['int'] = int(time_infos["maxh"])
-        datafrm = datafrm[list(map(int, \
-            datafrm[DEPART_TIME].str.slice(0, -3))) < datafrm['int']]
-        del datafrm['int']
-        return datafrm
-
-    def get_journeys(self, depart_city, time_infos, column_from, column_to):
-        """Calculate possibilities linked with the departure city."""
-        datafrm = pd.read_csv(self.csv_cut_path, sep=';')
-
-        datafrm = self.datetime_limit(datafrm, time_infos)
-        datafrm = datafrm[datafrm['Disponibilité de places MAX JEUNE et MAX SENIOR'] == 'OUI']
-        datafrm = datafrm[datafrm[column_from] == depart_city]
-        datafrm["CommonDest"] = datafrm[column_to]
+    def datetime_limit(self, time_infos):
+        """Get the date ordinal and departure minutes window to look up."""
+        return date_to_ordinal(time_infos["date"]), \
+            hour_to_minutes(time_infos["minh"]), \
+            hour_to_minutes(time_infos["maxh"])
+
+    def get_journeys(self, depart_city, time_infos, column_from, column_to, \
+            other_city=None):
+        """Calculate possibilities linked with the departure city.
+
+        Only rows to or from other_city are decoded when it is given.
+        """
+        city_code = self.snapshot.city_code(depart_city)
+        if city_code is None:
+            print("ERROR : unknown departure city " + depart_city)
+            rows = np.empty(0, dtype=np.int64)
+        else:
+            rows = self.index.lookup(INDEX_DIRECTIONS[column_from], city_code, \
+                *self.datetime_limit(time_infos))
+            if other_city is not None:
+                rows = rows[self.snapshot.column( \
+                    INDEX_OTHER_CITY[column_from])[rows] == \
+                    self.snapshot.city_code(other_city)]
+            rows = rows[self.snapshot.column(COL_DISPO)[rows]]
+
+        datafrm = self.snapshot.to_frame(rows)
+        datafrm[COMMON_DEST] = datafrm[column_to]
         return datafrm
 
-    def delete_oneway(self, dataframe, column1, column2):
-        """Delete lines with first column cities missing into 2nd column."""
-        for dest in column1:
-            found = False
-            for origin in column2:
-                if dest == origin:
-                    found = True
-                    break
-            if not found:
-                dataframe = dataframe[dataframe[DESTINATION] != dest]
-                dataframe = dataframe[dataframe[ORIGINE] != dest]
-        return dataframe
-
-    def keep_only_round_trips(self, dataframe):
-        """Delete one-way journeys."""
-        dataframe = self.delete_oneway(dataframe, \
-            dataframe[DESTINATION], dataframe[ORIGINE])
-        dataframe = self.delete_oneway(dataframe, \
-            dataframe[ORIGINE], dataframe[DESTINATION])
-        return dataframe
+    def add_connections(self, dataframe, depart_city, time_infos, \
+            max_transfers, min_transfer=MIN_TRANSFER_MIN, other_city=None):
+        """Add the earliest journey with transfers to cities without train.
+
+        Direct journeys are kept as they are, with no transfer. Only the
+        journey to other_city is added when it is given.
+        """
+        dataframe[TRANSFERS] = 0
+        dataframe[VIA] = ""
+        city_code = self.snapshot.city_code(depart_city)
+        if city_code is None:
+            return dataframe
+        connections = self.dataset.connection_scan().journeys(city_code, \
+            *self.datetime_limit(time_infos), int(min_transfer), \
+            int(max_transfers))
+        connections = connections[(connections[TRANSFERS] > 0) & \
+            ~connections[DESTINATION].isin(set(dataframe[COMMON_DEST]))]
+        if other_city is not None:
+            connections = connections[connections[DEST_CODE] == \
+                self.snapshot.city_code(other_city)]
+        connections[COMMON_DEST] = connections[DESTINATION]
+        return pd.concat([dataframe, connections], ignore_index=True)
+
+    def add_durations(self, dataframe, max_duration=None):
+        """Add trips duration in minutes, keeping max_duration hours at most."""
+        dataframe[DURATION] = (dataframe[ARRIVAL_MIN] - \
+            dataframe[DEPART_MIN]).astype(np.int64)
+        if max_duration is None:
+            return dataframe
+        return dataframe[dataframe[DURATION] <= float(max_duration) * 60]
+
+    def keep_only_round_trips(self, df_out, df_in):
+        """Delete journeys whose destination has no way back (semi-join)."""
+        common = set(df_out[COMMON_DEST]).intersection(df_in[COMMON_DEST])
+        return df_out[df_out[COMMON_DEST].isin(common)], \
+            df_in[df_in[COMMON_DEST].isin(common)]
+
+    def pair_round_trips(self, df_out, df_in, min_stay=None, max_stay=None):
+        """Pair every outbound journey with every return from its destination.
+
+        Returns leave once the outbound train has arrived, stay durations
+        are in hours between outbound and return departures.
+        """
+        df_out, df_in = self.keep_only_round_trips(df_out, df_in)
+        df_in = df_in[[COMMON_DEST, DATE, DEPART_TIME, DATE_ORD, DEPART_MIN]]
+        df_in.columns = [COMMON_DEST, RETURN_DATE, RETURN_TIME, \
+            RETURN_DATE_ORD, RETURN_MIN]
+        pairs = df_out.merge(df_in, on=COMMON_DEST)
+
+        # Arrival minutes count from the outbound departure day
+        return_min = (pairs[RETURN_DATE_ORD] - pairs[DATE_ORD]) * 24 * 60 + \
+            pairs[RETURN_MIN]
+        pairs[STAY] = return_min - pairs[DEPART_MIN]
+        valid = (pairs[STAY] > 0) & (return_min >= pairs[ARRIVAL_MIN])
+        if min_stay is not None:
+            valid &= pairs[STAY] >= float(min_stay) * 60
+        if max_stay is not None:
+            valid &= pairs[STAY] <= float(max_stay) * 60
+        return pairs[valid]
 
     def sort_journeys(self, dataframe):
         """Sort journeys by destination first, then date and finally hours."""
-        dataframe['hour_diz'] = dataframe[DEPART_TIME].str.get(-5)
-        dataframe['hour_uni'] = dataframe[DEPART_TIME].str.get(-4)
-        dataframe = dataframe.sort_values(by=['CommonDest', \
-            DATE, 'hour_diz', 'hour_uni'], na_position='first')
-
-        for col in ["CommonDest", "hour_diz", "hour_uni"]:
-            del dataframe[col]
-        dataframe.to_csv(self.csv_results_path)
+        by = [COMMON_DEST, DATE_ORD, DEPART_MIN]
+        if RETURN_MIN in dataframe:
+            by += [RETURN_DATE_ORD, RETURN_MIN]
+        dataframe = dataframe.sort_values(by=by, na_position='first')
+        del dataframe[COMMON_DEST]
+        return dataframe.reset_index(drop=True)
 
 
 class MapCreator:
     """Create Destinations map within user entries."""
 
-    def __init__(self, html_filepath, csv_cut_path, csv_coord_path, \
-            csv_result_path):
-        """Init the map creator with filepaths and DataProcess object."""
+    def __init__(self, html_filepath, dataset, csv_result_path=None, \
+            cache=None, shell=None):
+        """Init the map creator with filepaths and DataProcess object.
+
+        Results are only exported to csv_result_path when it is given, and
+        memoized into cache, a ResultCache, when it is given. With a
+        MapShell, searches write its payload instead of a full HTML map.
+        """
         pd.set_option('mode.chained_assignment', None)
         self.html_filepath = html_filepath
-        self.csv_cut_path = csv_cut_path
-        self.csv_coord_path = csv_coord_path
+        self.dataset = dataset
         self.csv_result_path = csv_result_path
-        self.data_process = DataProcess(csv_cut_path, csv_result_path)
-
-    def retrieve_geoloc(self, dest, dataframe, df_coord, row):
-        """Retrieve a city geolocalisation from the coordinates CSV."""
-        list_lat = df_coord[LAT]
-        list_lon = df_coord[LON]
-        found = False
-        row_coord = 0
-        for city in df_coord['CITY']:
-            if dest == city:
-                dataframe[LAT][row] = round(list_lat[row_coord], 6)
-                dataframe[LON][row] = round(list_lon[row_coord], 6)
-                found = True
-                break
-            row_coord += 1
-        if not found:
-            dataframe[LAT][row], dataframe[LON][row] = 0.0, 0.0
-            print("ERROR : " + dest + " geolocalisation not found")
-        return dataframe
+        self.cache = cache
+        self.shell = shell
+        self.data_process = DataProcess(dataset)
 
-    def add_geoloc(self, depart_city):
+    def add_geoloc(self, dataframe):
         """Add geolocalisation informations for each destination."""
-        dataframe = pd.read_csv(self.csv_result_path)
-        df_coord = pd.read_csv(self.csv_coord_path)
-
-        dataframe[LAT], dataframe[LON] = 0.0, 0.0
-        row = 0
-        for dest in dataframe[DESTINATION]:
-            if dest != depart_city:
-                dataframe = self.retrieve_geoloc(dest, dataframe, df_coord, row)
-            row += 1
-
-        for col in ['Unnamed: 0', 'Unnamed: 0.1']:
-            del dataframe[col]
-        dataframe.to_csv(self.csv_result_path)
+        coords = self.dataset.coords[dataframe[DEST_CODE].values]
+        missing = np.isnan(coords[:, 0])
+        if missing.any():
+            print("ERROR : geolocalisation not found for " + \
+                ", ".join(sorted(set(dataframe[DESTINATION][missing]))))
+        coords[missing] = 0.0
+        dataframe[LAT], dataframe[LON] = coords[:, 0], coords[:, 1]
+        return dataframe
 
     def get_origine_geoloc(self, origine):
         """Get origine city GPS coordinates."""
-        df_coord = pd.read_csv(self.csv_coord_path)
-        lat, lon = 0.0, 0.0
-        row_coord = 0
-        for city in df_coord['CITY']:
-            if origine == city:
-                lat = round(df_coord[LAT][row_coord], 6)
-                lon = round(df_coord[LON][row_coord], 6)
-                return [lat, lon]
-            row_coord += 1
-        print("ERROR : origine " + origine + " geolocalisation not found")
-        return [lat, lon]
-
-    def concat_travel_infos(self, dest, d_depart, h_depart, d_return, h_return):
-        """Concatenate travel infos."""
-        if (d_return and h_return):
-            return dest + " -- Aller le " + d_depart + " à " + h_depart + \
-                " -- Retour le " + d_return + " à " + h_return
-        return dest + " -- Aller le " + d_depart + " à " + h_depart
-
-    def display(self, origin, roundtrip):
-        """Display results onto an HTML geographic map."""
-        dataframe = pd.read_csv(self.csv_result_path)
-        depart_times = dataframe[DEPART_TIME]
+        code = self.dataset.snapshot.city_code(origine)
+        if code is None or np.isnan(self.dataset.coords[code, 0]):
+            print("ERROR : origine " + origine + " geolocalisation not found")
+            return [0.0, 0.0]
+        return list(self.dataset.coords[code])
+
+    def travel_infos(self, dataframe, roundtrip):
+        """Get distinct journeys with their tooltip line."""
+        subset = [DESTINATION, DATE, DEPART_TIME]
+        if roundtrip:
+            subset += [RETURN_DATE, RETURN_TIME]
+        journeys = dataframe.drop_duplicates(subset=subset)
+        infos = "Aller le " + journeys[DATE] + " à " + journeys[DEPART_TIME]
+        if TRANSFERS in journeys:
+            infos = infos.where(journeys[TRANSFERS] == 0, infos + " via " + \
+                journeys[VIA] + ", arrivée à " + journeys[ARRIVAL_TIME])
+        if DURATION in journeys:
+            infos = infos + " (" + minutes_to_durations(journeys[DURATION]) + \
+                ")"
+        if roundtrip:
+            infos = infos + " -- Retour le " + journeys[RETURN_DATE] + \
+                " à " + journeys[RETURN_TIME]
+        return journeys.assign(**{TRAVEL_INFOS : infos})
+
+    def aggregate_destinations(self, dataframe, roundtrip):
+        """Aggregate journeys into one row per destination."""
+        grouped = self.travel_infos(dataframe, roundtrip) \
+            .groupby(DESTINATION, sort=False)
+        return pd.DataFrame({
+            LAT : grouped[LAT].first(),
+            LON : grouped[LON].first(),
+            TRAVEL_INFOS : grouped[TRAVEL_INFOS].agg("<br>".join)
+        }).reset_index()
+
+    def destinations_geojson(self, destinations):
+        """Get destinations as a GeoJSON collection of points."""
+        return {
+            "type" : "FeatureCollection",
+            "features" : [{
+                "type" : "Feature",
+                "geometry" : {"type" : "Point", "coordinates" : [lon, lat]},
+                "properties" : {DESTINATION : dest, TRAVEL_INFOS : infos}
+            } for dest, lat, lon, infos in zip(destinations[DESTINATION], \
+                destinations[LAT], destinations[LON], \
+                destinations[TRAVEL_INFOS])]
+        }
+
+    def add_destinations_layer(self, destmap, dataframe, roundtrip, name, \
+            color, icon=None):
+        """Draw journeys destinations as one GeoJSON layer of a map.
+
+        Destinations are circles of the given color when there is no icon,
+        no layer is drawn without any destination.
+        """
+        import folium
+
+        destinations = self.aggregate_destinations(dataframe, roundtrip)
+        if destinations.empty:
+            return
+        if icon is None:
+            marker = folium.CircleMarker(radius=8, color=color, fill=True, \
+                fill_color=color, fill_opacity=0.8)
+        else:
+            marker = folium.Marker(icon=folium.Icon(color=color, icon=icon))
+        folium.GeoJson(self.destinations_geojson(destinations), name=name, \
+            marker=marker, tooltip=folium.GeoJsonTooltip(fields=[DESTINATION, \
+                TRAVEL_INFOS], labels=False) \
+        ).add_to(destmap)
+
+    def add_isochrone_layers(self, destmap, dataframe, roundtrip):
+        """Draw destinations as one layer per band of their shortest trip."""
+        import folium
+
+        shortest = dataframe.groupby(DESTINATION)[DURATION].transform("min")
+        bands = isochrone_bands(shortest.values)
+        for band, color in enumerate(ISOCHRONE_COLORS):
+            if (bands == band).any():
+                self.add_destinations_layer(destmap, dataframe[bands == band], \
+                    roundtrip, "<span style=\"color:" + color + \
+                    "\">&#9679;</span> " + isochrone_label(band), color)
+        folium.LayerControl(collapsed=False).add_to(destmap)
+
+    def render(self, dataframe, origin, roundtrip, isochrone=False):
+        """Build the geographic map of results, without saving it.
+
+        Destinations are drawn as one GeoJSON layer, one point each, those
+        only reached with transfers into a layer of their own. Isochrone
+        maps draw one layer per band of travel time instead.
+        """
+        import folium
 
         origin_coords = self.get_origine_geoloc(origin)
 
@@ -171,77 +356,194 @@ class MapCreator:
         folium.Marker(location=origin_coords, tooltip=origin, \
             icon=folium.Icon(color="green", icon="info-sign")).add_to(destmap)
 
-        h_depart, d_depart, h_return = "unknown", "unknown", "unknown"
-        prev_city, real_dest = "unknown", "unknown"
-        dest_points = [0.0, 0.0]
-        row = -1
-        for dest in dataframe[DESTINATION]:
-            row += 1
-            if dest == origin:
-                if dest == prev_city:
-                    if depart_times[row] == depart_times[row-1]:
-                        continue
-                    h_return += " ou " + depart_times[row]
-                else:
-                    h_return = depart_times[row]
-
-                travel_infos = self.concat_travel_infos(real_dest, d_depart, \
-                    h_depart, dataframe[DATE][row], h_return)
-
-                folium.Marker(location=dest_points, tooltip=travel_infos, \
-                    icon=folium.Icon(color="red", icon="info-sign") \
-                ).add_to(destmap)
-                prev_city = dest
-                continue
-
-            real_dest = dest
-            dest_points = [dataframe[LAT][row], \
-                dataframe[LON][row]]
-            d_depart = dataframe[DATE][row]
-            if dest == prev_city:
-                if depart_times[row] == depart_times[row-1]:
-                    continue
-                h_depart += " ou " + depart_times[row]
-            else:
-                h_depart = depart_times[row]
-
-            if not roundtrip:
-                travel_infos = self.concat_travel_infos(real_dest, d_depart, \
-                    h_depart, dataframe[DATE][row], h_return)
-                folium.Marker(location=dest_points, \
-                    tooltip=self.concat_travel_infos(dest, d_depart, h_depart, \
-                    "", ""), icon=folium.Icon(color="red", icon="info-sign") \
-                ).add_to(destmap)
-            prev_city = dest
-        destmap.save(self.html_filepath)
-
-    def generate(self, user_entries):
-        """Generate destinations map and save it into HTML format."""
+        if isochrone and DURATION in dataframe:
+            self.add_isochrone_layers(destmap, dataframe, roundtrip)
+            return destmap
+        connected = self.connected(dataframe)
+        self.add_destinations_layer(destmap, dataframe[~connected], roundtrip, \
+            HTML_LAYER, "red", "info-sign")
+        if connected.any():
+            self.add_destinations_layer(destmap, dataframe[connected], \
+                roundtrip, HTML_CONNECTIONS_LAYER, "blue", "transfer")
+        return destmap
+
+    def connected(self, dataframe):
+        """Get a mask of journeys with transfers."""
+        if TRANSFERS not in dataframe:
+            return pd.Series(False, index=dataframe.index)
+        return dataframe[TRANSFERS] > 0
+
+    def payload_destinations(self, dataframe, fields):
+        """Get payload destinations of journeys with the given fields."""
+        journeys = dataframe.drop_duplicates(subset=[DESTINATION] + fields)
+        rows = journeys[fields].values.tolist()
+        groups = journeys.groupby(DESTINATION, sort=False).indices
+        firsts = journeys.drop_duplicates(subset=[DESTINATION])
+        transfers = firsts[TRANSFERS] if TRANSFERS in firsts else \
+            [0] * len(firsts)
+        durations = journeys.groupby(DESTINATION, sort=False)[DURATION] \
+            .min() if DURATION in journeys else {}
+        return [{
+            "name" : dest,
+            "lat" : float(lat),
+            "lon" : float(lon),
+            "transfers" : int(nb_transfers),
+            "duration" : int(durations[dest]) if dest in durations else None,
+            "journeys" : [rows[row] for row in groups[dest]]
+        } for dest, lat, lon, nb_transfers in zip(firsts[DESTINATION], \
+            firsts[LAT], firsts[LON], transfers)]
+
+    def payload(self, dataframe, user_entries):
+        """Get destinations, coordinates and times as a versioned payload.
+
+        Journeys of a destination are [date, time] lists, with return date
+        and time appended for round trips. Destinations reached with
+        transfers have [date, time, arrival time, via] journeys instead.
+        Durations are the shortest outbound trips in minutes.
+        """
+        roundtrip = bool(user_entries["mode"])
+        fields = [DATE, DEPART_TIME]
+        if roundtrip:
+            fields += [RETURN_DATE, RETURN_TIME]
+        connected = self.connected(dataframe)
+        destinations = self.payload_destinations(dataframe[~connected], fields)
+        if connected.any():
+            destinations += self.payload_destinations(dataframe[connected], \
+                [DATE, DEPART_TIME, ARRIVAL_TIME, VIA])
+        origin = user_entries["origin_city"]
+        origin_lat, origin_lon = self.get_origine_geoloc(origin)
+        return {
+            "format" : PAYLOAD_FORMAT,
+            "format_version" : PAYLOAD_FORMAT_VERSION,
+            "data_version" : self.dataset.version,
+            "origin" : {"name" : origin, "lat" : float(origin_lat), \
+                "lon" : float(origin_lon)},
+            "roundtrip" : roundtrip,
+            "destinations" : destinations
+        }
+
+    def display(self, dataframe, origin, roundtrip, isochrone=False):
+        """Display results onto an HTML geographic map."""
+        self.render(dataframe, origin, roundtrip, isochrone).save( \
+            self.html_filepath)
+
+    def render_html(self, dataframe, user_entries):
+        """Get the HTML map of a search results, from cache if rendered."""
+        html = None
+        if self.cache is not None:
+            html = self.cache.get_html(self.dataset.version, user_entries)
+        if html is None:
+            html = self.render(dataframe, user_entries["origin_city"], \
+                user_entries["mode"], user_entries.get("isochrone")) \
+                .get_root().render()
+            if self.cache is not None:
+                self.cache.put_html(self.dataset.version, user_entries, html)
+        return html
+
+    def report(self, progress_cb, stage):
+        """Report the stage about to run, the callback may cancel it."""
+        if progress_cb is not None:
+            progress_cb(stage)
+
+    def search(self, user_entries, progress_cb=None):
+        """Get journeys matching user entries, from cache when possible."""
+        self.report(progress_cb, STAGE_FILTER)
+        if self.cache is None:
+            return self.compute(user_entries, progress_cb)
+        dataframe = self.cache.get_frame(self.dataset.version, user_entries)
+        if dataframe is None:
+            dataframe = self.compute(user_entries, progress_cb)
+            self.cache.put_frame(self.dataset.version, user_entries, dataframe)
+        return dataframe
+
+    def reachable(self, user_entries):
+        """Get destinations of a search, without decoding any journey.
+
+        Whole hours searches are answered by reachability bitsets, others
+        need full rows: HH:MM hours, stays, transfers, maximum durations,
+        a destination or a return on the departure day.
+        """
+        departure, back = user_entries["departure"], user_entries["return"]
+        hours = [departure["minh"], departure["maxh"]]
+        if user_entries["mode"]:
+            hours += [back["minh"], back["maxh"]]
+        minutes = [hour_to_minutes(hour) for hour in hours]
+        if any(minute % 60 for minute in minutes) or \
+                user_entries.get("min_stay") is not None or \
+                user_entries.get("max_stay") is not None or \
+                user_entries.get("max_transfers") or \
+                user_entries.get("max_duration") is not None or \
+                user_entries.get("destination") is not None or \
+                (user_entries["mode"] and back["date"] <= departure["date"]):
+            return sorted(set(self.search(user_entries)[DESTINATION]))
+
+        city_code = self.dataset.snapshot.city_code(user_entries["origin_city"])
+        if city_code is None:
+            print("ERROR : unknown departure city " + \
+                user_entries["origin_city"])
+            return []
+        hours = [minute // 60 for minute in minutes]
+        return_date = back["date"].toordinal() if user_entries["mode"] \
+            else None
+        codes = self.dataset.reachability.destinations(city_code, \
+            departure["date"].toordinal(), *hours[:2], return_date, \
+            *hours[2:])
+        return list(self.dataset.snapshot.decode_cities(codes))
+
+    def compute(self, user_entries, progress_cb=None):
+        """Filter, join, sort and geolocate journeys matching user entries."""
         mode_roundtrip = user_entries["mode"]
         depart_city = user_entries["origin_city"]
 
-        depart_time = user_entries["departure"]
-        depart_time["date"] = \
-		self.data_process.convert_date(depart_time["date"])
+        depart_time = dict(user_entries["departure"], date= \
+            self.data_process.convert_date(user_entries["departure"]["date"]))
+
+        dataframe = self.data_process.get_journeys(depart_city, depart_time, \
+            ORIGINE, DESTINATION, user_entries.get("destination"))
 
-        df_out = self.data_process.get_journeys(depart_city, depart_time, \
-            ORIGINE, DESTINATION)
-        df_out.to_csv(self.csv_result_path)
+        if not mode_roundtrip and user_entries.get("max_transfers"):
+            self.report(progress_cb, STAGE_CONNECTIONS)
+            dataframe = self.data_process.add_connections(dataframe, \
+                depart_city, depart_time, user_entries["max_transfers"], \
+                user_entries.get("min_transfer", MIN_TRANSFER_MIN), \
+                user_entries.get("destination"))
+
+        self.report(progress_cb, STAGE_DURATION)
+        dataframe = self.data_process.add_durations(dataframe, \
+            user_entries.get("max_duration"))
 
         if mode_roundtrip:
-            return_time = user_entries["return"]
-            return_time["date"] = \
-		    self.data_process.convert_date(return_time["date"])
+            return_time = dict(user_entries["return"], date= \
+                self.data_process.convert_date(user_entries["return"]["date"]))
             df_in = self.data_process.get_journeys(depart_city, return_time, \
-                DESTINATION, ORIGINE)
-            with open(self.csv_result_path, 'a') as file_towrite:
-                df_in.to_csv(file_towrite, header=False)
-            dataframe = pd.read_csv(self.csv_result_path)
-            dataframe = self.data_process.keep_only_round_trips(dataframe)
-            self.data_process.sort_journeys(dataframe)
-        else:
-            dataframe = pd.read_csv(self.csv_result_path)
-            self.data_process.sort_journeys(dataframe)
-        self.add_geoloc(depart_city)
-        self.display(depart_city, mode_roundtrip)
-        gc.collect()
+                DESTINATION, ORIGINE, user_entries.get("destination"))
+            self.report(progress_cb, STAGE_ROUNDTRIP)
+            dataframe = self.data_process.pair_round_trips(dataframe, df_in, \
+                user_entries.get("min_stay"), user_entries.get("max_stay"))
+        self.report(progress_cb, STAGE_SORT)
+        dataframe = self.data_process.sort_journeys(dataframe)
+        self.report(progress_cb, STAGE_GEOLOC)
+        return self.add_geoloc(dataframe)
+
+    def export(self, dataframe):
+        """Export results to CSV when an export path is configured."""
+        if self.csv_result_path is not None:
+            dataframe.to_csv(self.csv_result_path, index=False)
+
+    def generate(self, user_entries, progress_cb=None):
+        """Generate destinations map and save it into HTML format.
+
+        progress_cb is called with each stage name before it runs and may
+        raise SearchCancelled to stop the search.
+        """
+        dataframe = self.search(user_entries, progress_cb)
+        self.report(progress_cb, STAGE_EXPORT)
+        self.export(dataframe)
+        self.report(progress_cb, STAGE_DISPLAY)
+        if self.shell is not None:
+            self.shell.write_payload(self.payload(dataframe, user_entries))
+            return dataframe
+        html = self.render_html(dataframe, user_entries)
+        with open(self.html_filepath, 'w', encoding='utf-8') as outfile:
+            outfile.write(html)
+        return dataframe
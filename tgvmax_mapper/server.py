@@ -0,0 +1,319 @@
+"""Serve TGVmax destinations queries over local HTTP from a warm dataset."""
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from cache import ResultCache
+from connections import MIN_TRANSFER_MIN
+from dataset import Dataset
+from flexible import FlexibleSearch, make_flex_entries
+from query import run_query, public_columns
+from search import MapCreator, make_user_entries
+from settings import SERVER_WORKERS, MAP_SHELL_TEMPLATE
+from snapshot import ordinals_to_dates
+
+QUERY_TIMEOUT_S = 60
+JSON_TYPE = "application/json; charset=utf-8"
+HTML_TYPE = "text/html; charset=utf-8"
+METRICS_COUNTERS = ["requests", "errors", "queries", "maps", "payloads", \
+    "flex", "reachable", "reloads"]
+
+
+class NotFound(Exception):
+    """Raised for a query about a city missing from the data."""
+
+
+class QueryService:
+    """Dataset loaded once and shared by concurrent queries.
+
+    Searches run into a worker pool, request threads only wait for them.
+    A newer snapshot published by the refresher is picked up by the next
+    query, running queries keep the dataset they started with.
+    """
+
+    def __init__(self, store, csv_coords, workers=SERVER_WORKERS, \
+            refresher=None, cache_dir=None):
+        """Load the published dataset and start the worker pool."""
+        self.store = store
+        self.cache = ResultCache(spill_dir=cache_dir)
+        self.csv_coords = csv_coords
+        self.refresher = refresher
+        self.dataset = Dataset.load_current(store, csv_coords)
+        self.dataset_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.started = time.time()
+        self.metrics_lock = threading.Lock()
+        self.counters = {name : 0 for name in METRICS_COUNTERS}
+        self.query_time_s = 0.0
+        self.in_flight = 0
+
+    def count(self, name):
+        """Increment one metrics counter."""
+        with self.metrics_lock:
+            self.counters[name] += 1
+
+    def current_dataset(self):
+        """Get the dataset, reloaded first if a newer version is published."""
+        with self.dataset_lock:
+            if self.store.current_version() != self.dataset.version:
+                old_version = self.dataset.version
+                self.dataset = Dataset.load_current(self.store, self.csv_coords)
+                if self.refresher is not None:
+                    self.cache.carry_over(old_version, self.dataset.version, \
+                        self.refresher.refresher.diff_between(old_version, \
+                        self.dataset.version))
+                print("Dataset reloaded at version " + \
+                    str(self.dataset.version))
+                self.count("reloads")
+            return self.dataset
+
+    def search(self, user_entries):
+        """Get the dataset and the journeys matching user entries."""
+        dataset = self.current_dataset()
+        if dataset.snapshot.city_code(user_entries["origin_city"]) is None:
+            raise NotFound("unknown departure city " + \
+                user_entries["origin_city"])
+        return dataset, run_query(dataset, user_entries, self.cache)
+
+    def query_json(self, user_entries):
+        """Get journeys matching user entries as a JSON document."""
+        dataset, dataframe = self.search(user_entries)
+        return json.dumps({
+            "version" : dataset.version,
+            "count" : len(dataframe),
+            "journeys" : public_columns(dataframe).to_dict(orient="records")
+        }, ensure_ascii=False).encode()
+
+    def query_map(self, user_entries):
+        """Get the HTML map of journeys matching user entries."""
+        dataset, dataframe = self.search(user_entries)
+        return MapCreator(None, dataset, cache=self.cache).render_html( \
+            dataframe, user_entries).encode()
+
+    def query_payload(self, user_entries):
+        """Get the map shell payload of journeys matching user entries."""
+        dataset, dataframe = self.search(user_entries)
+        return json.dumps(MapCreator(None, dataset).payload(dataframe, \
+            user_entries), ensure_ascii=False, separators=(",", ":")).encode()
+
+    def query_reachable(self, user_entries):
+        """Get destinations of user entries as a JSON document."""
+        dataset = self.current_dataset()
+        if dataset.snapshot.city_code(user_entries["origin_city"]) is None:
+            raise NotFound("unknown departure city " + \
+                user_entries["origin_city"])
+        destinations = MapCreator(None, dataset, cache=self.cache) \
+            .reachable(user_entries)
+        return json.dumps({
+            "version" : dataset.version,
+            "count" : len(destinations),
+            "destinations" : destinations
+        }, ensure_ascii=False).encode()
+
+    def query_flex(self, user_entries):
+        """Get destination x date counts of a flexible search as JSON."""
+        dataset = self.current_dataset()
+        if dataset.snapshot.city_code(user_entries["origin_city"]) is None:
+            raise NotFound("unknown departure city " + \
+                user_entries["origin_city"])
+        flex_search = FlexibleSearch(dataset)
+        matrix = flex_search.compute(user_entries)
+        scores = flex_search.scores(matrix)
+        cities = np.flatnonzero(scores.any(axis=1))
+        return json.dumps({
+            "version" : dataset.version,
+            "dates" : list(ordinals_to_dates(matrix.dates)),
+            "destinations" : list(dataset.snapshot.decode_cities(cities)),
+            "outbounds" : matrix.outbounds[cities].tolist(),
+            "roundtrips" : None if matrix.roundtrips is None \
+                else matrix.roundtrips[cities].tolist()
+        }, ensure_ascii=False, separators=(",", ":")).encode()
+
+    def run(self, task, user_entries):
+        """Run a search task into the worker pool and wait for its result."""
+        with self.metrics_lock:
+            self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            future = self.executor.submit(task, user_entries)
+            return future.result(timeout=QUERY_TIMEOUT_S)
+        finally:
+            with self.metrics_lock:
+                self.in_flight -= 1
+                self.query_time_s += time.perf_counter() - start
+
+    def health(self):
+        """Get service status and served data version."""
+        return {
+            "status" : "ok",
+            "version" : self.dataset.version,
+            "refreshing" : bool(self.refresher and self.refresher.refreshing)
+        }
+
+    def metrics(self):
+        """Get requests counters and timings."""
+        with self.metrics_lock:
+            metrics = dict(self.counters)
+            searches = metrics["queries"] + metrics["maps"] + \
+                metrics["payloads"] + metrics["flex"] + metrics["reachable"]
+            metrics["in_flight"] = self.in_flight
+            metrics["query_time_s"] = round(self.query_time_s, 3)
+            metrics["mean_query_ms"] = round(self.query_time_s * 1000 / \
+                searches, 1) if searches else None
+        metrics["uptime_s"] = round(time.time() - self.started)
+        metrics["version"] = self.dataset.version
+        metrics["nb_rows"] = len(self.dataset.snapshot)
+        metrics["cache"] = self.cache.info()
+        return metrics
+
+    def shutdown(self):
+        """Stop the worker pool."""
+        self.executor.shutdown(wait=False)
+
+
+def parse_entries(params):
+    """Get user entries from query string parameters.
+
+    Malformed hours or stays raise ValueError from the search itself.
+    """
+    def param(name, default=None):
+        values = params.get(name)
+        return values[0] if values else default
+
+    if param("from") is None or param("date") is None:
+        raise ValueError("from and date parameters are required")
+    return_date = param("return")
+    if return_date is not None:
+        return_date = datetime.date.fromisoformat(return_date)
+    max_duration = param("max_duration")
+    return make_user_entries(param("from"), \
+        datetime.date.fromisoformat(param("date")), \
+        param("minh", "3"), param("maxh", "23"), return_date, \
+        param("return_minh", "3"), param("return_maxh", "23"), \
+        param("min_stay"), param("max_stay"), \
+        int(param("max_transfers", 0)), \
+        int(param("min_transfer", MIN_TRANSFER_MIN)), \
+        None if max_duration is None else float(max_duration), \
+        param("isochrone", "0") not in ("0", "false"), param("to"))
+
+
+def parse_flex_entries(params):
+    """Get flexible search user entries from query string parameters."""
+    def param(name, default=None):
+        values = params.get(name)
+        return values[0] if values else default
+
+    if param("from") is None:
+        raise ValueError("from parameter is required")
+    stay = param("stay")
+    return make_flex_entries(param("from"), param("minh", "3"), \
+        param("maxh", "23"), None if stay is None else int(stay), \
+        param("return_minh", "3"), param("return_maxh", "23"))
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Route GET requests to the query service of the server."""
+
+    def send_body(self, status, content_type, body):
+        """Send a complete response."""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data):
+        """Send a JSON response."""
+        self.send_body(status, JSON_TYPE, \
+            json.dumps(data, ensure_ascii=False).encode())
+
+    def do_GET(self):
+        """Answer /health, /metrics, /shell and search paths."""
+        service = self.server.service
+        service.count("requests")
+        url = urlsplit(self.path)
+        try:
+            if url.path == "/health":
+                self.send_json(200, service.health())
+            elif url.path == "/metrics":
+                self.send_json(200, service.metrics())
+            elif url.path == "/query":
+                body = service.run(service.query_json, \
+                    parse_entries(parse_qs(url.query)))
+                service.count("queries")
+                self.send_body(200, JSON_TYPE, body)
+            elif url.path == "/map":
+                body = service.run(service.query_map, \
+                    parse_entries(parse_qs(url.query)))
+                service.count("maps")
+                self.send_body(200, HTML_TYPE, body)
+            elif url.path == "/payload":
+                body = service.run(service.query_payload, \
+                    parse_entries(parse_qs(url.query)))
+                service.count("payloads")
+                self.send_body(200, JSON_TYPE, body)
+            elif url.path == "/reachable":
+                body = service.run(service.query_reachable, \
+                    parse_entries(parse_qs(url.query)))
+                service.count("reachable")
+                self.send_body(200, JSON_TYPE, body)
+            elif url.path == "/flex":
+                body = service.run(service.query_flex, \
+                    parse_flex_entries(parse_qs(url.query)))
+                service.count("flex")
+                self.send_body(200, JSON_TYPE, body)
+            elif url.path == "/shell":
+                self.send_body(200, HTML_TYPE, self.server.shell)
+            else:
+                self.send_json(404, {"error" : "unknown path " + url.path})
+        except ValueError as err:
+            service.count("errors")
+            self.send_json(400, {"error" : str(err)})
+        except NotFound as err:
+            service.count("errors")
+            self.send_json(404, {"error" : str(err)})
+        except TimeoutError:
+            service.count("errors")
+            self.send_json(503, {"error" : "query timed out"})
+        except Exception as err: # pylint: disable=broad-except
+            service.count("errors")
+            print("ERROR : query failed, " + repr(err))
+            self.send_json(500, {"error" : "internal error"})
+
+
+class QueryServer(ThreadingHTTPServer):
+    """HTTP server answering each request into its own thread."""
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        """Bind the server and attach the query service."""
+        super().__init__(address, QueryHandler)
+        self.service = service
+        with open(MAP_SHELL_TEMPLATE, 'rb') as infile:
+            self.shell = infile.read()
+
+
+def serve(store, csv_coords, host, port, workers=SERVER_WORKERS, \
+        refresher=None, cache_dir=None):
+    """Serve queries until interrupted, refreshing data if a refresher is set."""
+    service = QueryService(store, csv_coords, workers, refresher, cache_dir)
+    server = QueryServer((host, port), service)
+    if refresher is not None:
+        refresher.start()
+    print("Serving TGVmax queries on http://" + host + ":" + \
+        str(server.server_port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.shutdown()
+        if refresher is not None:
+            refresher.stop()
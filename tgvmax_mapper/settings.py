@@ -0,0 +1,27 @@
+"""Paths and data parameters shared by the UI, the CLI and the library."""
+
+# Resources
+RESOURCES_PATH = "resources/"
+SNAPSHOT_DIR = RESOURCES_PATH + "snapshot/"
+CSV_COORDS = RESOURCES_PATH + "city_coords.csv"
+UPDT_TMS_PATH = RESOURCES_PATH + "last_updt.json"
+SUBSCRIPTIONS_PATH = RESOURCES_PATH + "subscriptions.json"
+HTML_FILEPATH = RESOURCES_PATH + "map.html"
+FLEX_HTML_FILEPATH = RESOURCES_PATH + "flex_map.html"
+
+# Data download parameters
+OPENDATA_URL = "https://data.sncf.com/explore/dataset/tgvmax/download" + \
+    "/?format=csv&timezone=Europe/Berlin&use_labels_for_header=true"
+CHUNK_SIZE = 1024*1024
+UPDT_DELAY_S = 12*60*60
+
+# Local query server parameters
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8080
+SERVER_WORKERS = 4
+
+# Map rendering, "folium" for a full page per search or "shell" for
+# a static page written once and a payload per search
+MAP_RENDERER = "folium"
+MAP_SHELL_TEMPLATE = RESOURCES_PATH + "map_shell.html"
+MAP_SHELL_DIR = RESOURCES_PATH + "map/"
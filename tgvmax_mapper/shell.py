@@ -0,0 +1,46 @@
+"""Static map shell drawing search payloads client-side."""
+
+import json
+import os
+import shutil
+
+from settings import MAP_SHELL_TEMPLATE
+
+SHELL_FILE = "index.html"
+PAYLOAD_FILE = "map_payload.js"
+PAYLOAD_VARIABLE = "TGVMAX_PAYLOAD"
+
+
+class MapShell:
+    """Map page written once, each search only writing its payload.
+
+    The payload is wrapped into a script assignment, so that the shell
+    also loads it when opened from the file system.
+    """
+
+    def __init__(self, shell_dir, template_path=MAP_SHELL_TEMPLATE):
+        """Init the shell directory, installing the shell if outdated."""
+        self.shell_dir = shell_dir
+        self.template_path = template_path
+        self.shell_path = os.path.join(shell_dir, SHELL_FILE)
+        self.payload_path = os.path.join(shell_dir, PAYLOAD_FILE)
+        self.install()
+
+    def install(self):
+        """Copy the shell template unless an up to date copy exists."""
+        if os.path.isfile(self.shell_path) and \
+                os.path.getmtime(self.shell_path) >= \
+                os.path.getmtime(self.template_path):
+            return
+        os.makedirs(self.shell_dir, exist_ok=True)
+        shutil.copyfile(self.template_path, self.shell_path)
+
+    def write_payload(self, payload):
+        """Write a search payload for the shell to draw."""
+        temp_path = self.payload_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as outfile:
+            outfile.write(PAYLOAD_VARIABLE + " = ")
+            json.dump(payload, outfile, ensure_ascii=False, \
+                separators=(",", ":"))
+            outfile.write(";\n")
+        os.replace(temp_path, self.payload_path)
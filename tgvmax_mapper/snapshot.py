@@ -0,0 +1,169 @@
+"""Store TGVmax journeys into a typed columnar snapshot."""
+
+import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from store import META_FILE, SNAPSHOT_FORMAT
+
+# Source CSV columns
+DATE = "DATE"
+TRAIN_NO = "TRAIN_NO"
+ORIGINE = "Origine"
+DESTINATION = "Destination"
+DEPART_TIME = "Heure_depart"
+ARRIVAL_TIME = "Heure_arrivee"
+DISPO_MAX = "Disponibilité de places MAX JEUNE et MAX SENIOR"
+
+# Decoded frame typed columns
+DATE_ORD = "DATE_ordinal"
+DEPART_MIN = "Minute_depart"
+ARRIVAL_MIN = "Minute_arrivee"
+ORIGIN_CODE = "Origine_code"
+DEST_CODE = "Destination_code"
+
+# Snapshot columns
+COL_ORIGIN = "origin"
+COL_DEST = "destination"
+COL_DATE = "date"
+COL_DEPART = "depart"
+COL_ARRIVAL = "arrival"
+COL_DISPO = "dispo"
+COL_TRAIN = "train"
+COLUMNS_DTYPES = {
+    COL_ORIGIN : np.int16,
+    COL_DEST : np.int16,
+    COL_DATE : np.int32,
+    COL_DEPART : np.int16,
+    COL_ARRIVAL : np.int16,
+    COL_DISPO : np.bool_,
+    COL_TRAIN : np.int32
+}
+
+# Snapshot files
+CITIES_FILE = "cities.json"
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+MINUTES_PER_DAY = 24*60
+
+
+def date_to_ordinal(date_str):
+    """Convert a YYYY-MM-DD date into its integer day ordinal."""
+    return datetime.date.fromisoformat(date_str).toordinal()
+
+def ordinals_to_dates(ordinals):
+    """Vectorized conversion of day ordinals into YYYY-MM-DD dates."""
+    days = np.asarray(ordinals, dtype=np.int64) - EPOCH_ORDINAL
+    return days.astype("datetime64[D]").astype(str)
+
+def minutes_to_times(minutes):
+    """Vectorized conversion of minutes since midnight into HH:MM times."""
+    hours, mins = np.divmod(np.asarray(minutes, dtype=np.int64), 60)
+    return np.char.add(np.char.add(np.char.zfill(hours.astype(str), 2), \
+        ":"), np.char.zfill(mins.astype(str), 2))
+
+def train_to_number(train):
+    """Convert a train number into an integer, 0 if not numeric."""
+    return int(train) if train.isdigit() else 0
+
+
+class SnapshotWriter:
+    """Write journeys typed columns as one binary file per column."""
+
+    def __init__(self, snapshot_path):
+        """Init the writer with the snapshot directory."""
+        self.snapshot_path = snapshot_path
+
+    def write_columns(self, cities, columns):
+        """Write typed columns, the cities dictionary and metadata."""
+        os.makedirs(self.snapshot_path, exist_ok=True)
+        for name, values in columns.items():
+            np.save(os.path.join(self.snapshot_path, name + ".npy"), values)
+        with open(os.path.join(self.snapshot_path, CITIES_FILE), 'w') as outfile:
+            json.dump(cities, outfile, ensure_ascii=False)
+        meta = {
+            "format" : SNAPSHOT_FORMAT,
+            "nb_rows" : len(columns[COL_DATE]),
+            "columns" : {name : np.dtype(dtype).name \
+                for name, dtype in COLUMNS_DTYPES.items()}
+        }
+        with open(os.path.join(self.snapshot_path, META_FILE), 'w') as outfile:
+            json.dump(meta, outfile)
+
+
+class SnapshotReader:
+    """Read snapshot columns as memory-mapped arrays, without copying."""
+
+    def __init__(self, snapshot_path):
+        """Load snapshot metadata and cities dictionary."""
+        self.snapshot_path = snapshot_path
+        with open(os.path.join(snapshot_path, META_FILE)) as infile:
+            self.meta = json.load(infile)
+        with open(os.path.join(snapshot_path, CITIES_FILE)) as infile:
+            self.cities = json.load(infile)
+        self.city_codes = {city : code for code, city in enumerate(self.cities)}
+        self.columns = {}
+
+    def __len__(self):
+        """Number of journeys into the snapshot."""
+        return self.meta["nb_rows"]
+
+    def column(self, name):
+        """Get one column, memory-mapped on first access."""
+        if name not in self.columns:
+            filepath = os.path.join(self.snapshot_path, name + ".npy")
+            # Empty files cannot be memory-mapped
+            mmap_mode = 'r' if len(self) else None
+            self.columns[name] = np.load(filepath, mmap_mode=mmap_mode)
+        return self.columns[name]
+
+    def read_columns(self, names):
+        """Get only the requested columns."""
+        return {name : self.column(name) for name in names}
+
+    def city_code(self, city):
+        """Get the integer code of a city, None if unknown."""
+        return self.city_codes.get(city)
+
+    def decode_cities(self, codes):
+        """Get city names from their integer codes."""
+        return np.asarray(self.cities, dtype=object)[codes]
+
+    def manifest(self):
+        """Get sorted stations and dates range, for a fast UI start."""
+        dates = self.column(COL_DATE)
+        first_date, last_date = None, None
+        if len(dates):
+            first_date, last_date = map(str, \
+                ordinals_to_dates([dates.min(), dates.max()]))
+        return {
+            "stations" : list(self.cities),
+            "first_date" : first_date,
+            "last_date" : last_date
+        }
+
+    def to_frame(self, rows):
+        """Decode selected rows into a dataframe with the CSV columns.
+
+        Arrival minutes are counted from the departure day midnight.
+        """
+        cols = self.read_columns([COL_ORIGIN, COL_DEST, COL_DATE, COL_DEPART, \
+            COL_ARRIVAL])
+        departs = cols[COL_DEPART][rows]
+        arrivals = cols[COL_ARRIVAL][rows].astype(np.int64)
+        return pd.DataFrame(data={
+            DATE : ordinals_to_dates(cols[COL_DATE][rows]),
+            ORIGINE : self.decode_cities(cols[COL_ORIGIN][rows]),
+            DESTINATION : self.decode_cities(cols[COL_DEST][rows]),
+            DEPART_TIME : minutes_to_times(departs),
+            ARRIVAL_TIME : minutes_to_times(arrivals),
+            DATE_ORD : cols[COL_DATE][rows],
+            DEPART_MIN : departs,
+            ARRIVAL_MIN : np.where(arrivals < departs, \
+                arrivals + MINUTES_PER_DAY, arrivals),
+            ORIGIN_CODE : cols[COL_ORIGIN][rows],
+            DEST_CODE : cols[COL_DEST][rows]
+        })
@@ -0,0 +1,162 @@
+"""Versioned snapshots directories, readable without loading any data."""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "publish.lock"
+MANIFEST_FILE = "manifest.json"
+META_FILE = "meta.json"
+# Snapshot columns layout, bumped when columns are added or changed
+SNAPSHOT_FORMAT = 3
+VERSION_PREFIX = "v"
+TEMP_PREFIX = "tmp-"
+KEPT_VERSIONS = 2
+# Temporary directories left by an interrupted refresh are deleted after
+STALE_TEMP_S = 24*60*60
+
+
+class PublishLock:
+    """Lock file held by one process at a time while publishing."""
+
+    def __init__(self, store_path):
+        """Init the lock from the store directory."""
+        self.filepath = os.path.join(store_path, LOCK_FILE)
+        self.lockfile = None
+
+    def __enter__(self):
+        """Wait for the lock."""
+        self.lockfile = open(self.filepath, 'a')
+        if os.name == "nt":
+            import msvcrt
+            self.lockfile.seek(0)
+            msvcrt.locking(self.lockfile.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        """Release the lock."""
+        if os.name == "nt":
+            import msvcrt
+            self.lockfile.seek(0)
+            msvcrt.locking(self.lockfile.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_UN)
+        self.lockfile.close()
+
+
+class SnapshotStore:
+    """Versioned snapshots, the current one being swapped atomically.
+
+    Each version lives into its own directory and the CURRENT file names
+    the published one. New versions are built into a temporary directory
+    then published with a rename, so readers never see a partial write.
+    Several processes may refresh the same store, each builds into its own
+    temporary directory and publishing is serialized by a lock file.
+    """
+
+    def __init__(self, store_path):
+        """Init the store from its root directory."""
+        self.store_path = store_path
+
+    def version_path(self, version):
+        """Get the directory of one snapshot version."""
+        return os.path.join(self.store_path, VERSION_PREFIX + str(version))
+
+    def current_version(self):
+        """Get the published version number, 0 if none."""
+        filepath = os.path.join(self.store_path, CURRENT_FILE)
+        if not os.path.isfile(filepath):
+            return 0
+        with open(filepath) as infile:
+            return int(infile.read())
+
+    def current(self):
+        """Get the published version and its directory, from one read.
+
+        The directory is None if no snapshot was published or if it has an
+        older format, which then has to be downloaded again.
+        """
+        version = self.current_version()
+        return version, self.checked_path(version)
+
+    def current_path(self):
+        """Get the published snapshot directory, None if not usable."""
+        return self.current()[1]
+
+    def checked_path(self, version):
+        """Get the directory of a version, None if missing or outdated."""
+        if not version:
+            return None
+        snapshot_path = self.version_path(version)
+        try:
+            with open(os.path.join(snapshot_path, META_FILE)) as infile:
+                snapshot_format = json.load(infile)["format"]
+        except (OSError, ValueError, KeyError):
+            return None
+        if snapshot_format != SNAPSHOT_FORMAT:
+            return None
+        return snapshot_path
+
+    def read_manifest(self):
+        """Get the published version manifest, None if missing."""
+        current_path = self.current_path()
+        if current_path is None:
+            return None
+        try:
+            with open(os.path.join(current_path, MANIFEST_FILE)) as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self, snapshot_path, manifest, version):
+        """Write a snapshot manifest along with its version number."""
+        filepath = os.path.join(snapshot_path, MANIFEST_FILE)
+        with open(filepath + ".tmp", 'w') as outfile:
+            json.dump(dict(manifest, version=version), outfile, \
+                ensure_ascii=False)
+        os.replace(filepath + ".tmp", filepath)
+
+    def new_temp_path(self):
+        """Get a new empty temporary directory for building a version."""
+        os.makedirs(self.store_path, exist_ok=True)
+        return tempfile.mkdtemp(dir=self.store_path, prefix=TEMP_PREFIX)
+
+    def publish(self, temp_path, manifest=None):
+        """Swap a built snapshot in as the current one, return its version.
+
+        The version number is read under the publish lock, a version
+        published meanwhile by another process is never overwritten. The
+        manifest, if any, is written with the version number before the
+        swap so that it always matches the published data.
+        """
+        with PublishLock(self.store_path):
+            version = self.current_version() + 1
+            if manifest is not None:
+                self.write_manifest(temp_path, manifest, version)
+            shutil.rmtree(self.version_path(version), ignore_errors=True)
+            os.rename(temp_path, self.version_path(version))
+            current_tmp = os.path.join(self.store_path, CURRENT_FILE + ".tmp")
+            with open(current_tmp, 'w') as outfile:
+                outfile.write(str(version))
+            os.replace(current_tmp, os.path.join(self.store_path, \
+                CURRENT_FILE))
+            self.prune(version)
+        return version
+
+    def prune(self, version):
+        """Delete versions older than the kept ones, and stale temporaries."""
+        for name in os.listdir(self.store_path):
+            path = os.path.join(self.store_path, name)
+            if name.startswith(VERSION_PREFIX) and name[1:].isdigit() and \
+                    int(name[1:]) <= version - KEPT_VERSIONS:
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.startswith(TEMP_PREFIX) and os.path.isdir(path) and \
+                    time.time() - os.path.getmtime(path) > STALE_TEMP_S:
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,269 @@
+"""Saved searches evaluated all together on each published snapshot."""
+
+from collections import namedtuple
+import datetime
+import json
+import os
+
+import numpy as np
+
+from dataset import Dataset
+from index import OUTBOUND, RETURN, PERM, MINUTES
+from search import MapCreator, DESTINATION, hour_to_minutes
+from snapshot import COL_ORIGIN, COL_DEST, COL_DISPO
+
+SUBSCRIPTIONS = "subscriptions"
+RESULTS = "results"
+CORRUPT_SUFFIX = ".corrupt"
+DATE_KEYS = ["departure", "return"]
+
+SubscriptionChange = namedtuple("SubscriptionChange", ["sub_id", "name", \
+    "gained", "lost"])
+
+
+def entries_to_json(user_entries):
+    """Get user entries with dates as YYYY-MM-DD strings."""
+    entries = dict(user_entries)
+    for key in DATE_KEYS:
+        date = entries[key]["date"]
+        entries[key] = dict(entries[key], \
+            date=None if date is None else date.isoformat())
+    return entries
+
+def entries_from_json(entries):
+    """Get user entries back from their JSON form."""
+    user_entries = dict(entries)
+    for key in DATE_KEYS:
+        date = entries[key]["date"]
+        user_entries[key] = dict(entries[key], \
+            date=None if date is None else datetime.date.fromisoformat(date))
+    return user_entries
+
+def is_grouped(user_entries):
+    """Check a saved search is answered by the grouped scan.
+
+    Stays, transfers, durations, a destination or a return on the
+    departure day need the full search instead.
+    """
+    return user_entries.get("min_stay") is None and \
+        user_entries.get("max_stay") is None and \
+        not user_entries.get("max_transfers") and \
+        user_entries.get("max_duration") is None and \
+        user_entries.get("destination") is None and \
+        (not user_entries["mode"] or \
+            user_entries["return"]["date"] > user_entries["departure"]["date"])
+
+
+class SubscriptionStore:
+    """Saved searches and their last destinations into one JSON file."""
+
+    def __init__(self, filepath):
+        """Load saved searches, none if the file does not exist yet.
+
+        An unreadable file is moved aside, rather than overwritten later.
+        """
+        self.filepath = filepath
+        self.data = {SUBSCRIPTIONS : {}, RESULTS : {}}
+        if not os.path.isfile(filepath):
+            return
+        try:
+            with open(filepath) as infile:
+                data = json.load(infile)
+            if not isinstance(data, dict) or not all(isinstance( \
+                    data.get(key), dict) for key in self.data):
+                raise ValueError("missing " + " or ".join(self.data))
+            self.data = data
+        except ValueError as err:
+            os.replace(filepath, filepath + CORRUPT_SUFFIX)
+            print("ERROR : unreadable saved searches, moved to " + \
+                filepath + CORRUPT_SUFFIX + ", " + str(err))
+
+    def save(self):
+        """Write saved searches atomically."""
+        temp_path = self.filepath + ".tmp"
+        with open(temp_path, 'w') as outfile:
+            json.dump(self.data, outfile, ensure_ascii=False)
+        os.replace(temp_path, self.filepath)
+
+    def add(self, name, user_entries):
+        """Save a search, get its id."""
+        ids = [int(sub_id) for sub_id in self.data[SUBSCRIPTIONS]]
+        sub_id = str(max(ids, default=0) + 1)
+        self.data[SUBSCRIPTIONS][sub_id] = {"name" : name, \
+            "entries" : entries_to_json(user_entries)}
+        self.save()
+        return sub_id
+
+    def remove(self, sub_id):
+        """Delete a saved search, False if unknown."""
+        if self.data[SUBSCRIPTIONS].pop(sub_id, None) is None:
+            return False
+        self.data[RESULTS].pop(sub_id, None)
+        self.save()
+        return True
+
+    def subscriptions(self):
+        """Get saved searches as {id : (name, user entries)}.
+
+        Malformed saved searches are reported and skipped.
+        """
+        subscriptions = {}
+        for sub_id, sub in self.data[SUBSCRIPTIONS].items():
+            try:
+                subscriptions[sub_id] = (sub["name"], \
+                    entries_from_json(sub["entries"]))
+            except (KeyError, TypeError, ValueError) as err:
+                print("ERROR : malformed saved search " + sub_id + ", " + \
+                    repr(err))
+        return subscriptions
+
+    def update(self, version, destinations):
+        """Store new destinations of saved searches, get what changed.
+
+        Searches evaluated for the first time only get their destinations
+        stored, they have nothing to compare with.
+        """
+        changes = []
+        for sub_id, names in destinations.items():
+            previous = self.data[RESULTS].get(sub_id)
+            if previous is not None and previous["version"] != version:
+                gained = sorted(set(names) - set(previous["destinations"]))
+                lost = sorted(set(previous["destinations"]) - set(names))
+                if gained or lost:
+                    changes.append(SubscriptionChange(sub_id, \
+                        self.data[SUBSCRIPTIONS][sub_id]["name"], gained, lost))
+            if previous is None or previous["version"] != version:
+                self.data[RESULTS][sub_id] = {"version" : version, \
+                    "destinations" : names}
+        self.save()
+        return changes
+
+
+class SubscriptionEngine:
+    """Evaluate many saved searches with one index scan per (city, date).
+
+    Searches sharing an origin and a date share one slice of the journeys
+    index, matched against all their hours windows at once. The cost grows
+    with distinct (origin, date) pairs, bounded by the data, rather than
+    with the number of saved searches.
+    """
+
+    def __init__(self, dataset):
+        """Init the engine with the dataset to evaluate searches on."""
+        self.dataset = dataset
+
+    def reached(self, direction, city_codes, dates, min_minutes, max_minutes):
+        """Get cities reached by each search, as a searches x cities mask.
+
+        Returns are cities with a train to the origin in their window.
+        """
+        snapshot = self.dataset.snapshot
+        index = self.dataset.index
+        other = snapshot.column(COL_DEST if direction == OUTBOUND \
+            else COL_ORIGIN)
+        dispo = snapshot.column(COL_DISPO)
+        reached = np.zeros((len(city_codes), len(snapshot.cities)), \
+            dtype=np.bool_)
+        keys = np.stack([city_codes, dates], axis=1)
+        groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind='stable')
+        bounds = np.searchsorted(inverse.ravel()[order], \
+            np.arange(len(groups) + 1))
+
+        for group, (city_code, date) in enumerate(groups):
+            searches = order[bounds[group]:bounds[group + 1]]
+            start, end = index.bucket_bounds(direction, city_code, date)
+            rows = index.arrays[direction][PERM][start:end]
+            available = dispo[rows]
+            minutes = index.arrays[direction][MINUTES][start:end][available]
+            cities = other[rows[available]]
+            inside = (minutes >= min_minutes[searches, None]) & \
+                (minutes < max_minutes[searches, None])
+            matches, journeys = np.nonzero(inside)
+            reached[searches[matches], cities[journeys]] = True
+        return reached
+
+    def evaluate(self, subscriptions):
+        """Get destinations of saved searches, as {id : sorted names}."""
+        grouped = {sub_id : entries for sub_id, (_, entries) \
+            in subscriptions.items() if is_grouped(entries) and \
+            self.dataset.snapshot.city_code(entries["origin_city"]) \
+            is not None}
+        destinations = {}
+        map_creator = MapCreator(None, self.dataset)
+        for sub_id, (_, entries) in subscriptions.items():
+            if sub_id not in grouped:
+                destinations[sub_id] = sorted(set( \
+                    map_creator.search(entries)[DESTINATION]))
+        if not grouped:
+            return destinations
+
+        sub_ids = list(grouped)
+        entries = [grouped[sub_id] for sub_id in sub_ids]
+        city_codes = np.array([self.dataset.snapshot.city_code( \
+            user_entries["origin_city"]) for user_entries in entries])
+        reached = self.reached(OUTBOUND, city_codes, \
+            np.array([user_entries["departure"]["date"].toordinal() \
+                for user_entries in entries]), \
+            *self.windows(entries, "departure"))
+
+        roundtrips = np.flatnonzero([user_entries["mode"] \
+            for user_entries in entries])
+        if len(roundtrips):
+            returns = [entries[pos] for pos in roundtrips]
+            reached[roundtrips] &= self.reached(RETURN, \
+                city_codes[roundtrips], \
+                np.array([user_entries["return"]["date"].toordinal() \
+                    for user_entries in returns]), \
+                *self.windows(returns, "return"))
+
+        for sub_id, cities in zip(sub_ids, reached):
+            destinations[sub_id] = list(self.dataset.snapshot.decode_cities( \
+                np.flatnonzero(cities)))
+        return destinations
+
+    def windows(self, entries, direction):
+        """Get min and max departure minutes of searches in one direction."""
+        return np.array([hour_to_minutes(user_entries[direction]["minh"]) \
+            for user_entries in entries]), \
+            np.array([hour_to_minutes(user_entries[direction]["maxh"]) \
+            for user_entries in entries])
+
+
+def check_subscriptions(dataset, filepath):
+    """Evaluate saved searches of a file on a dataset, get what changed."""
+    store = SubscriptionStore(filepath)
+    subscriptions = store.subscriptions()
+    if not subscriptions:
+        return []
+    destinations = SubscriptionEngine(dataset).evaluate(subscriptions)
+    return store.update(dataset.version, destinations)
+
+def change_line(change):
+    """Get a readable line of a saved search change."""
+    line = "Alerte " + change.sub_id + " (" + change.name + ") :"
+    if change.gained:
+        line += " +" + str(len(change.gained)) + " " + ", ".join(change.gained)
+    if change.lost:
+        line += " -" + str(len(change.lost)) + " " + ", ".join(change.lost)
+    return line
+
+
+class SubscriptionWatcher:
+    """Check saved searches of a file each time a snapshot is published."""
+
+    def __init__(self, store, csv_coords, filepath):
+        """Init the watcher with the snapshot store and saved searches file."""
+        self.store = store
+        self.csv_coords = csv_coords
+        self.filepath = filepath
+
+    def check(self, version=None):
+        """Evaluate saved searches on the published snapshot, print changes."""
+        if not os.path.isfile(self.filepath):
+            return []
+        changes = check_subscriptions(Dataset.load_current(self.store, \
+            self.csv_coords), self.filepath)
+        for change in changes:
+            print(change_line(change))
+        return changes
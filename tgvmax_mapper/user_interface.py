@@ -1,46 +1,35 @@
 """Contains graphical user interface object used by TGVmax destinations map."""
 
-import os
-import os.path
 from tkinter import Tk, Frame, Label, Radiobutton, Scale, Button, StringVar
 from tkinter import GROOVE, HORIZONTAL, LEFT, RIGHT
 from tkinter import ttk
 import datetime
+import os.path
+import time
 
 from tkcalendar import Calendar
 import webbrowser
-import requests
-import pandas as pd
 
-from geoloc import GeolocUpdater
+# Data modules pulling pandas, folium or requests are imported on first use,
+# so that the window shows up without waiting for them
 from data_validity import TimeKeeper
-from search import MapCreator
-
-# Resources
-RESOURCES_PATH = "resources/"
-CSV_CUT = RESOURCES_PATH + "cut_tgvs.csv"
-CSV_COORDS = RESOURCES_PATH + "city_coords.csv"
-CSV_RESULT = RESOURCES_PATH + "result.csv"
-UPDT_TMS_PATH = RESOURCES_PATH + "last_updt.json"
-HTML_FILEPATH = RESOURCES_PATH + "map.html"
-
-# Data download parameters
-OPENDATA_URL = "https://data.sncf.com/explore/dataset/tgvmax/download" + \
-    "/?format=csv&timezone=Europe/Berlin&use_labels_for_header=true"
-CHUNK_SIZE = 1024*1024*1024
-UPDT_DELAY_S = 12*60*60
-
-# CSV useless columns
-DISPO_TGVMAX = "Disponibilité de places TGV Max"
-ENTITY = "ENTITY"
-AXE = "Axe"
-TRAIN_NO = "TRAIN_NO"
-CODE_EQUIP = "CODE_EQUIP"
-DEST_IATA = "Destination IATA"
-ORIGINE_IATA = "Origine IATA"
-ARRIVAL_TIME = "Heure_arrivee"
-USELESS_COLUMNS = [DISPO_TGVMAX, ENTITY, AXE, TRAIN_NO, CODE_EQUIP, \
-  DEST_IATA, ORIGINE_IATA, ARRIVAL_TIME]
+from jobs import SearchRunner
+from settings import SNAPSHOT_DIR, CSV_COORDS, UPDT_TMS_PATH, HTML_FILEPATH
+from settings import OPENDATA_URL, CHUNK_SIZE, UPDT_DELAY_S
+from settings import SUBSCRIPTIONS_PATH
+from settings import MAP_RENDERER, MAP_SHELL_DIR, FLEX_HTML_FILEPATH
+from shell import MapShell
+from store import SnapshotStore
+
+# UI polling delays
+VERSION_CHECK_MS = 5000
+SEARCH_POLL_MS = 100
+# Results count labels, searches give trips, flexible ones destinations
+FOUND_TRIPS = " trajets trouvés"
+FOUND_DESTINATIONS = " destinations trouvées"
+
+# Time from process start to the first window shown
+STARTUP_TARGET_MS = 500
 
 # HTML parameters
 HTML_MAPNAME = "TGVmax destinations map"
@@ -58,6 +47,8 @@ DEPART_MAXH = "depart_maxh"
 RETURN_DATE = "return_date"
 RETURN_MINH = "return_minh"
 RETURN_MAXH = "return_maxh"
+TRANSFERS = "transfers"
+DURATION = "duration"
 LABELS = {
     MODE : "Mode de recherche",
     CITY : "Ville de départ",
@@ -67,16 +58,12 @@ LABELS = {
     DEPART_MAXH : "Heure maximum de départ pour l'aller",
     RETURN_MINH : "Heure minimum de départ pour le retour",
     RETURN_MAXH : "Heure maximum de départ pour le retour",
-    RETURN_DATE : "Date de retour"
-}
-DEPARTURE_INFOS = {"date" : "2019-01-01", "minh" : "3", "maxh" : "23"}
-RETURN_INFOS = {"date" : "2019-01-01", "minh" : "3", "maxh" : "23"}
-DEFAULT_USER_INPUTS = {
-    "mode" : "unknown",
-    "origin_city" : "unknown",
-    "departure" : DEPARTURE_INFOS,
-    "return" : RETURN_INFOS
+    RETURN_DATE : "Date de retour",
+    TRANSFERS : "Correspondances maximum pour l'aller simple",
+    DURATION : "Durée maximum de l'aller en heures (0 sans limite)"
 }
+MAX_TRANSFERS = 2
+MAX_DURATION_H = 12
 
 # Style parameters
 RELIEF_TYPE = GROOVE
@@ -90,9 +77,13 @@ class LoadingUi:
     """UI loading display for downloading data when the app is starting."""
 
     def __init__(self):
-        """Init loadingUI if timestamp is outdated."""
+        """Init loadingUI if no data was ever downloaded.
+
+        Outdated data is refreshed in background by MainUi instead.
+        """
         self.time_keeper = TimeKeeper(UPDT_TMS_PATH, UPDT_DELAY_S)
-        if not self.time_keeper.is_tms_outdated():
+        self.store = SnapshotStore(SNAPSHOT_DIR)
+        if self.store.current_path() is not None:
             self.update_needed = False
             return
         self.update_needed = True
@@ -103,29 +94,24 @@ class LoadingUi:
             length=200, mode="determinate")
         self.progress_label = Label(self.root)
 
-    def download_data(self, url, chunk_size, csv_path, cols_useless):
+    def show_progress(self, bytes_seen, bytes_total):
+        """Update progress bar from downloaded bytes."""
+        if bytes_total:
+            percent = min(100, round(bytes_seen*100/bytes_total))
+            text = str(percent) + " %"
+        else:
+            # Without Content-Length, keep the bar moving on bytes seen
+            percent = (bytes_seen // (1024*1024)) % 100
+            text = str(round(bytes_seen/(1024*1024), 1)) + " Mo"
+        self.progress["value"] = percent
+        self.progress_label.config(text=text)
+        self.root.update()
+
+    def download_data(self, url, chunk_size, store):
         """Download TGVmax possiblities from SNCF open database."""
-        response = requests.get(url, stream=True)
-        with open(csv_path, "wb") as handle:
-            nb_chunks_dl = 0
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                if chunk:  # filter out keep-alive new chunks
-                    handle.write(chunk)
-                    nb_chunks_dl += 1
-                    percent = round(nb_chunks_dl*100/88)
-                    print("Wait... "+str(percent)+"%")
-                    self.progress["value"] = percent
-                    self.progress_label.config(text=str(percent) + " %")
-                    self.progress.pack(padx=10, pady=10)
-                    self.progress_label.pack(padx=10)
-                    self.root.update()
-
-        data = pd.read_csv(csv_path, sep=';')
-        data = data[data[DISPO_TGVMAX] == 'OUI']
-        for col in cols_useless:
-            del data[col]
-        os.remove(csv_path)
-        data.to_csv(csv_path)
+        from refresh import DataRefresher
+        refresher = DataRefresher(url, store, self.time_keeper, chunk_size)
+        refresher.refresh(self.show_progress)
 
     def start_data_updt_cb(self):
         """Start data update."""
@@ -133,15 +119,14 @@ class LoadingUi:
         self.progress.pack(padx=10, pady=10)
         self.progress_label.pack(padx=10)
         self.root.update()
-        self.download_data(OPENDATA_URL, CHUNK_SIZE, CSV_CUT, USELESS_COLUMNS)
-        self.time_keeper.write_cur_tms()
+        self.download_data(OPENDATA_URL, CHUNK_SIZE, self.store)
         self.root.destroy()
 
     def config(self):
         """Configure loadingUI elements."""
         self.root.title(APP_TITLE)
         self.label.config( \
-            text="Les données SNCF locales datent de plus de 12 heures")
+            text="Aucune donnée SNCF locale, téléchargement nécessaire")
         self.button_action.config(command=self.start_data_updt_cb, \
             text="METTRE A JOUR")
         self.progress["value"] = 0
@@ -161,8 +146,27 @@ class LoadingUi:
 class MainUi:
     """Graphical user interface."""
 
-    def __init__(self):
-        """Initialise UI elements with their parents"""
+    def __init__(self, start_time=None):
+        """Initialise UI elements with their parents.
+
+        Only the snapshot manifest is read here, the dataset is loaded by the
+        search worker once the window is shown.
+        """
+        self.start_time = start_time or time.perf_counter()
+        self.store = SnapshotStore(SNAPSHOT_DIR)
+        self.manifest = self.store.read_manifest()
+        self.dataset = None
+        self.map_creator = None
+        self.flex_search = None
+        self.cache = None
+        self.shell = None
+        self.map_path = HTML_FILEPATH
+        if MAP_RENDERER == "shell":
+            self.shell = MapShell(MAP_SHELL_DIR)
+            self.map_path = self.shell.shell_path
+        self.refresher = None
+        self.runner = SearchRunner()
+        self.loading = None
         self.root = Tk()
         self.width = self.root.winfo_screenwidth()
         self.height = self.root.winfo_screenheight()
@@ -183,6 +187,10 @@ class MainUi:
         self.label_hour_depart_max = Label(self.frame2_1)
         self.scale_hour_depart_min = Scale(self.frame2_1)
         self.scale_hour_depart_max = Scale(self.frame2_1)
+        self.label_transfers = Label(self.frame2_1)
+        self.scale_transfers = Scale(self.frame2_1)
+        self.label_duration = Label(self.frame2_1)
+        self.scale_duration = Scale(self.frame2_1)
         self.calendar_depart = Calendar(self.frame2_1)
         self.label_date_return = Label(self.frame2_2)
         self.scale_hour_return_min = Scale(self.frame2_2)
@@ -194,36 +202,154 @@ class MainUi:
 
         self.frame3 = Frame(self.root)
         self.button_action = Button(self.frame3)
+        self.button_flex = Button(self.frame3)
+        self.button_cancel = Button(self.frame3)
+        self.label_progress = Label(self.frame3)
         self.roundtrip_choice = None
 
-    def search_cb(self):
-        """Callback for search button."""
-        self.button_action.config(text="CHARGEMENT ...")
-        self.button_action.pack(padx=10, pady=10)
-        self.root.update()
-
+    def load_data(self):
+        """Load the dataset and start refreshing it, off the UI loop."""
+        from cache import ResultCache
+        from dataset import Dataset
+        from geoloc import GeolocUpdater, CSV_GEOCODE_CACHE
+        from refresh import DataRefresher, BackgroundRefresher
+        from flexible import FlexibleSearch
+        from search import MapCreator
+        from subscriptions import SubscriptionWatcher
+        dataset = Dataset.load_current(self.store, CSV_COORDS)
+        if self.store.read_manifest() is None:
+            # Snapshot published before manifests existed
+            self.store.write_manifest(dataset.snapshot.snapshot_path, \
+                dataset.snapshot.manifest(), dataset.version)
+        if self.cache is None:
+            self.cache = ResultCache()
+        elif self.dataset is not None and self.refresher is not None:
+            self.cache.carry_over(self.dataset.version, dataset.version, \
+                self.refresher.refresher.diff_between(self.dataset.version, \
+                dataset.version))
+        self.map_creator = MapCreator(HTML_FILEPATH, dataset, \
+            cache=self.cache, shell=self.shell)
+        self.flex_search = FlexibleSearch(dataset, FLEX_HTML_FILEPATH)
+        self.dataset = dataset
+        if self.refresher is None:
+            watcher = SubscriptionWatcher(self.store, CSV_COORDS, \
+                SUBSCRIPTIONS_PATH)
+            self.refresher = BackgroundRefresher(DataRefresher(OPENDATA_URL, \
+                self.store, TimeKeeper(UPDT_TMS_PATH, UPDT_DELAY_S), \
+                CHUNK_SIZE, watcher.check, GeolocUpdater(None, \
+                CSV_GEOCODE_CACHE, CSV_COORDS)))
+            self.refresher.start()
+
+    def first_window_cb(self):
+        """Report startup time once the window is shown, then load data."""
+        elapsed_ms = round((time.perf_counter() - self.start_time)*1000)
+        if elapsed_ms > STARTUP_TARGET_MS:
+            print("WARNING : first window shown in " + str(elapsed_ms) + \
+                " ms, target is " + str(STARTUP_TARGET_MS) + " ms")
+        else:
+            print("First window shown in " + str(elapsed_ms) + " ms")
+        self.loading = self.runner.preload(self.load_data)
+
+    def get_user_inputs(self):
+        """Read a search user inputs from UI elements.
+
+        A maximum duration also colors destinations by travel time.
+        """
+        from search import make_user_entries
+        max_duration = self.scale_duration.get() or None
+        if not self.roundtrip_choice:
+            return make_user_entries(self.menu_cities.get(), \
+                self.calendar_depart.selection_get(), \
+                self.scale_hour_depart_min.get(), \
+                self.scale_hour_depart_max.get(), \
+                max_transfers=self.scale_transfers.get(), \
+                max_duration=max_duration, \
+                isochrone=max_duration is not None)
+        return make_user_entries(self.menu_cities.get(), \
+            self.calendar_depart.selection_get(), \
+            self.scale_hour_depart_min.get(), \
+            self.scale_hour_depart_max.get(), \
+            self.calendar_return.selection_get(), \
+            self.scale_hour_return_min.get(), \
+            self.scale_hour_return_max.get(), \
+            max_duration=max_duration, isochrone=max_duration is not None)
+
+    def get_flex_inputs(self):
+        """Read a flexible dates search user inputs from UI elements.
+
+        Round trips stay as many days as between the selected dates.
+        """
+        from flexible import make_flex_entries
+        stay_days = None
+        if self.roundtrip_choice:
+            stay_days = max(1, (self.calendar_return.selection_get() - \
+                self.calendar_depart.selection_get()).days)
+        return make_flex_entries(self.menu_cities.get(), \
+            self.scale_hour_depart_min.get(), \
+            self.scale_hour_depart_max.get(), stay_days, \
+            self.scale_hour_return_min.get(), \
+            self.scale_hour_return_max.get())
+
+    def search_cb(self, flexible=False):
+        """Callback for search button, superseding any running search."""
         if self.roundtrip_choice is None:
             print("Choisissez un mode (aller ou aller/retour)")
             return
-        user_inputs = DEFAULT_USER_INPUTS
-        user_inputs["mode"] = self.roundtrip_choice
-        user_inputs["origin_city"] = self.menu_cities.get()
-        user_inputs["departure"]["date"] = self.calendar_depart.selection_get()
-        user_inputs["departure"]["minh"] = self.scale_hour_depart_min.get()
-        user_inputs["departure"]["maxh"] = self.scale_hour_depart_max.get()
-
-        if self.roundtrip_choice:
-            user_inputs["return"]["date"] = self.calendar_return.selection_get()
-            user_inputs["return"]["minh"] = self.scale_hour_return_min.get()
-            user_inputs["return"]["maxh"] = self.scale_hour_return_max.get()
+        if self.loading is None or not self.loading.done():
+            self.label_progress.config(text="Chargement des données ...")
+            self.root.after(SEARCH_POLL_MS, self.search_cb, flexible)
+            return
+        if self.loading.exception() is not None:
+            print("ERROR : data loading failed, " + \
+                str(self.loading.exception()))
+            self.label_progress.config(text="Erreur de chargement des données")
+            return
+        if flexible:
+            job = self.runner.submit(self.flex_search, self.get_flex_inputs())
+            map_path = FLEX_HTML_FILEPATH
+            found = FOUND_DESTINATIONS
+        else:
+            job = self.runner.submit(self.map_creator, self.get_user_inputs())
+            map_path = self.map_path
+            found = FOUND_TRIPS
+        self.label_progress.config(text="CHARGEMENT ...")
+        self.button_cancel.pack(padx=10, pady=10)
+        self.root.after(SEARCH_POLL_MS, self.poll_search, job, map_path, \
+            found)
+
+    def flex_cb(self):
+        """Callback for flexible dates button."""
+        self.search_cb(flexible=True)
+
+    def cancel_cb(self):
+        """Callback for cancel button."""
+        self.runner.cancel()
+
+    def poll_search(self, job, map_path, found=FOUND_TRIPS):
+        """Show search progress until its results are ready.
+
+        found labels the results count, trips or destinations.
+        """
+        if job is not self.runner.current:
+            return
+        for stage in job.pop_stages():
+            self.label_progress.config(text=stage + " ...")
+        if not job.future.done():
+            self.root.after(SEARCH_POLL_MS, self.poll_search, job, map_path, \
+                found)
+            return
 
-        map_creator = MapCreator(HTML_FILEPATH, CSV_CUT, CSV_COORDS, CSV_RESULT)
-        map_creator.generate(user_inputs)
-        self.button_action.config(text="Lancer la recherche")
-        self.button_action.pack(padx=10, pady=10)
-        self.root.update()
-        del map_creator
-        webbrowser.get('open -a /Applications/Google\ Chrome.app %s').open(HTML_FILEPATH)
+        self.button_cancel.pack_forget()
+        if job.is_cancelled():
+            self.label_progress.config(text="Recherche annulée")
+            return
+        if job.future.exception() is not None:
+            print("ERROR : search failed, " + str(job.future.exception()))
+            self.label_progress.config(text="Erreur pendant la recherche")
+            return
+        self.label_progress.config(text=str(len(job.future.result())) + \
+            found)
+        webbrowser.open("file://" + os.path.abspath(map_path))
 
     def checkbox_roundtrip_cb(self):
         """Callback for roundtrip checkbox."""
@@ -252,14 +378,15 @@ class MainUi:
         self.checkbox_roundtrip.configure(text="Aller-retour", \
             value=1, command=self.checkbox_roundtrip_cb)
 
-        self.cities = GeolocUpdater.get_dest_list(CSV_CUT)
-        self.menu_cities.configure(values=self.cities)
+        self.config_cities()
         self.menu_cities.set("Choisissez une ville de départ")
 
         self.label_date_depart.configure(text=LABELS[DEPART_DATE])
         self.label_date_return.configure(text=LABELS[RETURN_DATE])
         self.label_hour_depart_min.configure(text=LABELS[DEPART_MINH])
         self.label_hour_depart_max.configure(text=LABELS[DEPART_MAXH])
+        self.label_transfers.configure(text=LABELS[TRANSFERS])
+        self.label_duration.configure(text=LABELS[DURATION])
         self.label_hour_return_min.configure(text=LABELS[RETURN_MINH])
         self.label_hour_return_max.configure(text=LABELS[RETURN_MAXH])
 
@@ -271,6 +398,12 @@ class MainUi:
         self.scale_hour_depart_max.configure(from_=3, to=24, resolution=1, \
             orient=HORIZONTAL, length=scale_length, width=20, tickinterval=20, \
             variable=StringVar(value=23))
+        self.scale_transfers.configure(from_=0, to=MAX_TRANSFERS, \
+            resolution=1, orient=HORIZONTAL, length=scale_length, width=20, \
+            tickinterval=1, variable=StringVar(value=0))
+        self.scale_duration.configure(from_=0, to=MAX_DURATION_H, \
+            resolution=1, orient=HORIZONTAL, length=scale_length, width=20, \
+            tickinterval=3, variable=StringVar(value=0))
         self.scale_hour_return_min.configure(from_=3, to=24, resolution=1, \
             orient=HORIZONTAL, length=scale_length, width=20, tickinterval=20, \
             variable=StringVar(value=3))
@@ -280,6 +413,9 @@ class MainUi:
 
         mindate = datetime.date.today()
         maxdate = mindate + datetime.timedelta(days=31)
+        if self.manifest is not None and self.manifest["last_date"]:
+            maxdate = max(mindate, \
+                datetime.date.fromisoformat(self.manifest["last_date"]))
         self.calendar_depart.configure(selectmode='day', locale='fr', \
             mindate=mindate, maxdate=maxdate, \
             disabledforeground='red', cursor="hand1")
@@ -290,6 +426,15 @@ class MainUi:
 
         self.button_action.configure(text="Lancer la recherche", \
             command=self.search_cb)
+        self.button_flex.configure(text="Dates flexibles", \
+            command=self.flex_cb)
+        self.button_cancel.configure(text="Annuler", command=self.cancel_cb)
+
+    def config_cities(self):
+        """Fill departure cities from the snapshot manifest."""
+        if self.manifest is not None:
+            self.cities = self.manifest["stations"]
+        self.menu_cities.configure(values=self.cities)
 
     def config_background(self):
         """Configure elements background color."""
@@ -304,10 +449,15 @@ class MainUi:
         self.label_date_depart.configure(bg=BG_COLOR)
         self.label_hour_depart_min.configure(bg=BG_COLOR)
         self.label_hour_depart_max.configure(bg=BG_COLOR)
+        self.label_transfers.configure(bg=BG_COLOR)
+        self.label_duration.configure(bg=BG_COLOR)
         self.label_date_return.configure(bg=BG_COLOR)
         self.label_hour_return_min.configure(bg=BG_COLOR)
         self.label_hour_return_max.configure(bg=BG_COLOR)
         self.button_action.configure(bg="white")
+        self.button_flex.configure(bg="white")
+        self.button_cancel.configure(bg="white")
+        self.label_progress.configure(bg=BG_COLOR)
         self.label_middle_calendar.configure(bg="green")
 
     def config_foreground(self):
@@ -318,9 +468,12 @@ class MainUi:
         self.label_date_depart.configure(fg=FG_COLOR)
         self.label_hour_depart_min.configure(fg=FG_COLOR)
         self.label_hour_depart_max.configure(fg=FG_COLOR)
+        self.label_transfers.configure(fg=FG_COLOR)
+        self.label_duration.configure(fg=FG_COLOR)
         self.label_date_return.configure(fg=FG_COLOR)
         self.label_hour_return_min.configure(fg=FG_COLOR)
         self.label_hour_return_max.configure(fg=FG_COLOR)
+        self.label_progress.configure(fg=FG_COLOR)
 
     def config_border(self):
         """Configure frame borders."""
@@ -344,6 +497,8 @@ class MainUi:
         self.label_date_depart.configure(font=PARAM_FONT)
         self.label_hour_depart_min.configure(font=PARAM_FONT)
         self.label_hour_depart_max.configure(font=PARAM_FONT)
+        self.label_transfers.configure(font=PARAM_FONT)
+        self.label_duration.configure(font=PARAM_FONT)
         self.label_date_return.configure(font=PARAM_FONT)
         self.label_hour_return_min.configure(font=PARAM_FONT)
         self.label_hour_return_max.configure(font=PARAM_FONT)
@@ -382,6 +537,10 @@ class MainUi:
         self.scale_hour_depart_min.pack()
         self.label_hour_depart_max.pack(padx=10, pady=10)
         self.scale_hour_depart_max.pack(pady=10)
+        self.label_transfers.pack(padx=10, pady=10)
+        self.scale_transfers.pack(pady=10)
+        self.label_duration.pack(padx=10, pady=10)
+        self.scale_duration.pack(pady=10)
 
         self.label_date_return.pack(padx=10)
         self.calendar_return.pack(padx=10)
@@ -391,7 +550,26 @@ class MainUi:
         self.scale_hour_return_max.pack(pady=10)
 
         self.button_action.pack(padx=10, pady=10)
+        self.button_flex.pack(padx=10, pady=10)
+        self.label_progress.pack(padx=10, pady=10)
+
+    def check_data_version(self):
+        """Switch searches to the newest published snapshot version."""
+        if self.loading.done() and (self.dataset is None or \
+                self.store.current_version() != self.dataset.version):
+            self.loading = self.runner.preload(self.load_data)
+        manifest = self.store.read_manifest()
+        if manifest is not None and (self.manifest is None or \
+                manifest["version"] != self.manifest["version"]):
+            self.manifest = manifest
+            self.config_cities()
+        self.root.after(VERSION_CHECK_MS, self.check_data_version)
 
     def run(self):
         """Run the graphical interface loop."""
+        self.root.after_idle(self.first_window_cb)
+        self.root.after(VERSION_CHECK_MS, self.check_data_version)
         self.root.mainloop()
+        self.runner.shutdown()
+        if self.refresher is not None:
+            self.refresher.stop()